@@ -29,6 +29,7 @@ from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.sampler import RandomSampler, SequentialSampler
 from tqdm import tqdm, trange
 
+from util.checkpoint import build_from_checkpoint, load_checkpoint
 from util.optimization import BERTAdam
 from util.processor import (Sentihood_NLI_M_Processor,
                             Semeval_NLI_M_Processor)
@@ -226,7 +227,7 @@ def getModelOptimizerTokenizer(model_type, vocab_file, embed_file=None,
         # if pretrain, we will load here
         if init_checkpoint is not None:
             logger.info("retraining with saved model.")
-            checkpoint = torch.load(init_checkpoint, map_location='cpu')
+            checkpoint = load_checkpoint(init_checkpoint)
             model.load_state_dict(checkpoint)
     elif model_type == "BERTSimple":
         logger.info("model = BERTSimple")
@@ -320,16 +321,19 @@ def getModelOptimizerTokenizer(model_type, vocab_file, embed_file=None,
         # vocab size is shrinked.
         bert_config.vocab_size = len(tokenizer.vocab)
         # model and optimizer
-        model = ContextAwareBertForSequenceClassification(
-                    bert_config, len(label_list),
-                    init_weight=True)
-        if init_checkpoint is not None:
+        def build():
+            return ContextAwareBertForSequenceClassification(
+                        bert_config, len(label_list),
+                        init_weight=True)
+        if init_checkpoint is not None and "checkpoint" in init_checkpoint:
             logger.info("retraining with saved model.")
-            # only load fields that are avaliable
-            if "checkpoint" in init_checkpoint:
-                # load full is it is not google BERT original pretrain
-                model.load_state_dict(torch.load(init_checkpoint, map_location='cpu'), strict=False)
-            else:
+            # load full is it is not google BERT original pretrain
+            model = build_from_checkpoint(build, init_checkpoint, strict=False)
+        else:
+            model = build()
+            if init_checkpoint is not None:
+                logger.info("retraining with saved model.")
+                # only load fields that are avaliable
                 model.bert.load_state_dict(torch.load(init_checkpoint, map_location='cpu'), strict=False)
         #######################################################################
         # Instead of BERTAdam, we use Adam to be able to perform gs on bias
@@ -411,17 +415,20 @@ def getModelOptimizerTokenizer(model_type, vocab_file, embed_file=None,
         # vocab size is shrinked.
         bert_config.vocab_size = len(tokenizer.vocab)
         # model and optimizer
-        model = HeadwiseContextAwareBertForSequenceClassification(
-                    bert_config, len(label_list),
-                    init_weight=True)
-        if init_checkpoint is not None:
+        def build():
+            return HeadwiseContextAwareBertForSequenceClassification(
+                        bert_config, len(label_list),
+                        init_weight=True)
+        if init_checkpoint is not None and "checkpoint" in init_checkpoint:
             logger.info("retraining with saved model.")
-            # only load fields that are avaliable
-            if "checkpoint" in init_checkpoint:
-                logger.info("retraining with a checkpoint model instead.")
-                # load full is it is not google BERT original pretrain
-                model.load_state_dict(torch.load(init_checkpoint, map_location='cpu'), strict=False)
-            else:
+            logger.info("retraining with a checkpoint model instead.")
+            # load full is it is not google BERT original pretrain
+            model = build_from_checkpoint(build, init_checkpoint, strict=False)
+        else:
+            model = build()
+            if init_checkpoint is not None:
+                logger.info("retraining with saved model.")
+                # only load fields that are avaliable
                 model.bert.load_state_dict(torch.load(init_checkpoint, map_location='cpu'), strict=False)
         no_decay = ['bias', 'gamma', 'beta']
         optimizer_parameters = [
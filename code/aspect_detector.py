@@ -1,12 +1,17 @@
-from tqdm import tqdm
 from model.QACGBERT import *
 from util.tokenization import *
+from util.checkpoint import build_from_checkpoint
+from util.data import batch_to_device
+from util.features import truncate_seq_pair
+from util.precision import autocast, quantize
 import numpy as np
 import pandas as pd
 import random
-from torch.utils.data import DataLoader, TensorDataset
 
 
+# aspects are expanded per sentence, so nothing here needs autograd
+_inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
 label_list = ['Yes', 'No']
 
 context_id_map_fiqa = {"legal": 0, "m&a": 1, "regulatory": 2, "risks": 3, "rumors": 4, "company communication": 5,
@@ -14,36 +19,6 @@ context_id_map_fiqa = {"legal": 0, "m&a": 1, "regulatory": 2, "risks": 3, "rumor
                        "fundamentals": 11, "price action": 12, "insider activity": 13, "ipo": 14, "others": 15}
 
 
-class InputExample(object):
-    def __init__(self, guid, text_a, text_b=None, label=None):
-        self.guid = guid
-        self.text_a = text_a
-        self.text_b = text_b
-        self.label = label
-
-
-class InputFeatures(object):
-    def __init__(self, input_ids, input_mask, segment_ids, label_id, seq_len,
-                 context_ids):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.label_id = label_id
-        self.seq_len = seq_len
-        self.context_ids = context_ids
-
-
-def truncate_seq_pair(tokens_a, tokens_b, max_length):
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
 def convert_to_unicode(text):
     if six.PY3:
         if isinstance(text, str):
@@ -56,108 +31,11 @@ def convert_to_unicode(text):
         raise ValueError("Not running on Python 3")
 
 
-def get_test_examples(path):
-    test_data = pd.read_csv(path, header=None).values
-    def _create_examples(lines, set_type):
-        examples = []
-        for (i, line) in enumerate(lines):
-            guid = "%s-%s" % (set_type, i)
-            text_a = convert_to_unicode(str(line[1]))
-            text_b = convert_to_unicode(str(line[0]))
-            label = convert_to_unicode(str(line[0]))
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        return examples
-    return _create_examples(test_data, "test")
-
-
-def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer, max_context_length,
-                                 # if this is true, the context will not be
-                                 # appened into the inputs
-                                 context_standalone, args):
-    """Loads a data file into a list of `InputBatch`s."""
-
-    label_map = {}
-    for (i, label) in enumerate(label_list):
-        label_map[label] = i
-
-    features = []
-    for (ex_index, example) in enumerate(tqdm(examples)):
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-        tokens_context = None
-        if example.text_b:
-            tokens_context = tokenizer.tokenize(example.text_b)
-
-        if tokens_b and not context_standalone:
-            truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-        else:
-            if len(tokens_a) > max_seq_length - 2:
-                tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-        tokens = []
-        segment_ids = []
-        tokens.append("[CLS]")
-        segment_ids.append(0)
-        for token in tokens_a:
-            tokens.append(token)
-            segment_ids.append(0)
-        tokens.append("[SEP]")
-        segment_ids.append(0)
-
-        if tokens_b and not context_standalone:
-            for token in tokens_b:
-                tokens.append(token)
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        context_ids = []
-        if tokens_context:
-            context_ids = [context_id_map_fiqa[example.text_b]]
-
-        input_mask = [1] * len(input_ids)
-
-        seq_len = len(input_ids)
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        while len(context_ids) < max_context_length:
-            context_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(context_ids) == max_context_length
-
-        label_id = 0
-
-        features.append(
-            InputFeatures(
-                input_ids=input_ids,
-                input_mask=input_mask,
-                segment_ids=segment_ids,
-                label_id=label_id,
-                seq_len=seq_len,
-                # newly added context part
-                context_ids=context_ids))
-
-    return features
-
-
 def get_model_and_tokenizer(vocab_file,
                                bert_config_file=None, init_checkpoint=None,
                                label_list=None, do_lower_case=True,
-                               init_lrp=False):
-    tokenizer = FullTokenizer(
+                               init_lrp=False, quantized=False):
+    tokenizer = FastFullTokenizer(
         vocab_file=vocab_file, do_lower_case=do_lower_case, pretrain=False)
     if bert_config_file is not None:
         bert_config = BertConfig.from_json_file(bert_config_file)
@@ -175,24 +53,23 @@ def get_model_and_tokenizer(vocab_file,
             initializer_range=0.02
         )
     bert_config.vocab_size = len(tokenizer.vocab)
-    model = QACGBertForSequenceClassification(
-        bert_config, len(label_list),
-        init_weight=True,
-        init_lrp=init_lrp)
-
-    if init_checkpoint is not None:
-        if "checkpoint" in init_checkpoint:
-            state_dict = torch.load(init_checkpoint, map_location='cpu')
-            from collections import OrderedDict
-            new_state_dict = OrderedDict()
-            for k, v in state_dict.items():
-                if k.startswith('module.'):
-                    name = k[7:]
-                    new_state_dict[name] = v
-                else:
-                    new_state_dict[k] = v
-            model.load_state_dict(new_state_dict)
-        else:
+
+    def build():
+        model = QACGBertForSequenceClassification(
+            bert_config, len(label_list),
+            init_weight=True,
+            init_lrp=init_lrp)
+        if quantized:
+            # checkpoints written by quantize_checkpoint.py
+            model = quantize(model)
+        return model
+
+    if init_checkpoint is not None and (quantized or "checkpoint" in init_checkpoint):
+        # quantized layers cannot be built on the meta device
+        model = build_from_checkpoint(build, init_checkpoint, skip_init=not quantized)
+    else:
+        model = build()
+        if init_checkpoint is not None:
             model.bert.load_state_dict(torch.load(init_checkpoint, map_location='cpu'), strict=False)
     return model, tokenizer
 
@@ -223,28 +100,130 @@ def system_setups(args):
     return device, n_gpu
 
 
+class AspectDetector(object):
+    """Batched multi-aspect inference engine.
+
+    Every sentence is tokenized once and expanded across all the aspects in
+    `context_id_map_fiqa`; the expanded rows are run through the model in
+    batches of `batch_size` without tracking gradients, in bfloat16 autocast
+    with `precision="bf16"`. With `compiled`, the model is compiled with
+    torch.compile for every sequence length in `buckets` up front and each
+    batch is padded to the shortest that fits (see `util.compiled`).
+    """
+
+    def __init__(self, model, tokenizer, device, max_seq_length=128,
+                 context_standalone=False, batch_size=256, precision="fp32",
+                 compiled=False, buckets=(32, 64, 96, 128)):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.precision = precision
+        self.max_seq_length = max_seq_length
+        self.context_standalone = context_standalone
+        self.batch_size = batch_size
+        self.aspects = list(context_id_map_fiqa)
+        self.aspect_tokens = [tokenizer.tokenize(aspect) for aspect in self.aspects]
+        self.yes_label = label_list.index('Yes')
+        # with standalone contexts every aspect variant of a sentence has the
+        # same tokens, so the model can share the aspect-independent compute.
+        # DataParallel scatters arbitrary row chunks, which would split groups.
+        self.aspect_group_size = None
+        if context_standalone and not isinstance(model, torch.nn.DataParallel):
+            self.aspect_group_size = len(self.aspects)
+            self.batch_size = max(1, batch_size // len(self.aspects)) * len(self.aspects)
+        self.compiled_model = None
+        if compiled:
+            # imports torch._dynamo, which takes a while
+            from util.compiled import BucketedModel
+            # a fixed batch layout, the aspect groups are not shared
+            self.aspect_group_size = None
+            buckets = [b for b in buckets if b < max_seq_length] + [max_seq_length]
+            self.compiled_model = BucketedModel(model, device, self.batch_size, buckets)
+            with autocast(device, precision):
+                self.compiled_model.warmup()
+
+    def _expand(self, sentences):
+        """Builds padded inputs of shape (len(sentences) * n_aspects, max_seq_length)."""
+        n_aspects = len(self.aspects)
+        n_rows = len(sentences) * n_aspects
+        # stored compactly and widened per batch on the device
+        input_ids = np.zeros((n_rows, self.max_seq_length), dtype=np.int32)
+        input_mask = np.zeros((n_rows, self.max_seq_length), dtype=np.uint8)
+        segment_ids = np.zeros((n_rows, self.max_seq_length), dtype=np.uint8)
+        seq_lens = np.zeros((n_rows, 1), dtype=np.int32)
+        context_ids = np.tile(
+            np.array([context_id_map_fiqa[a] for a in self.aspects], dtype=np.uint8),
+            len(sentences)).reshape(n_rows, 1)
+
+        row = 0
+        for sentence in sentences:
+            sentence_tokens = self.tokenizer.tokenize(convert_to_unicode(str(sentence)))
+            standalone = None
+            for aspect_tokens in self.aspect_tokens:
+                if self.context_standalone or not aspect_tokens:
+                    # the aspect is not part of the inputs, so every aspect
+                    # shares the same token ids
+                    if standalone is None:
+                        tokens_a = sentence_tokens[:self.max_seq_length - 2]
+                        standalone = self.tokenizer.convert_tokens_to_ids(
+                            ["[CLS]"] + tokens_a + ["[SEP]"])
+                    ids, n_a = standalone, len(standalone)
+                else:
+                    tokens_a = list(sentence_tokens)
+                    tokens_b = list(aspect_tokens)
+                    truncate_seq_pair(tokens_a, tokens_b, self.max_seq_length - 3)
+                    ids = self.tokenizer.convert_tokens_to_ids(
+                        ["[CLS]"] + tokens_a + ["[SEP]"] + tokens_b + ["[SEP]"])
+                    n_a = len(tokens_a) + 2
+                input_ids[row, :len(ids)] = ids
+                input_mask[row, :len(ids)] = 1
+                segment_ids[row, n_a:len(ids)] = 1
+                seq_lens[row, 0] = len(ids)
+                row += 1
+        return input_ids, input_mask, segment_ids, seq_lens, context_ids
+
+    def predict_proba(self, sentences):
+        """Returns label probabilities of shape (len(sentences), n_aspects, n_labels)."""
+        input_ids, input_mask, segment_ids, seq_lens, context_ids = \
+            self._expand(sentences)
+        self.model.eval()
+        probs = []
+        with _inference_mode(), autocast(self.device, self.precision):
+            for start in range(0, len(input_ids), self.batch_size):
+                end = start + self.batch_size
+                # truncate to save space and computing resource
+                max_seq_lens = int(seq_lens[start:end].max())
+                batch_input_ids, batch_input_mask, batch_segment_ids, batch_seq_lens, \
+                    batch_context_ids = batch_to_device(
+                        [torch.from_numpy(input_ids[start:end, :max_seq_lens]),
+                         torch.from_numpy(input_mask[start:end, :max_seq_lens]),
+                         torch.from_numpy(segment_ids[start:end, :max_seq_lens]),
+                         torch.from_numpy(seq_lens[start:end]),
+                         torch.from_numpy(context_ids[start:end])], self.device)
+
+                if self.compiled_model is not None:
+                    logits = self.compiled_model(batch_input_ids, batch_segment_ids,
+                                                 batch_input_mask, batch_context_ids)
+                else:
+                    logits = self.model(batch_input_ids, batch_segment_ids, batch_input_mask,
+                                        batch_seq_lens, device=self.device,
+                                        context_ids=batch_context_ids,
+                                        aspect_group_size=self.aspect_group_size)
+                probs.append(F.softmax(logits, dim=-1).cpu().numpy())
+        probs = np.concatenate(probs, axis=0)
+        return probs.reshape(len(sentences), len(self.aspects), -1)
+
+    def predict(self, sentences):
+        """Returns an (len(sentences), n_aspects) matrix, 1 where the aspect is detected."""
+        probs = self.predict_proba(sentences)
+        return (np.argmax(probs, axis=-1) == self.yes_label).astype(np.int64)
+
+
 def data_and_model_loader(device, n_gpu, args):
     model, tokenizer = get_model_and_tokenizer(vocab_file=args.vocab_file,
                                 bert_config_file=args.bert_config_file, init_checkpoint=args.init_checkpoint,
                                 label_list=label_list, do_lower_case=True,
-                                init_lrp=False)
-
-    test_examples = get_test_examples(args.path)
-    test_features = convert_examples_to_features(
-        test_examples, label_list, args.max_seq_length,
-        tokenizer, args.max_context_length,
-        args.context_standalone, args)
-
-    all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_id for f in test_features], dtype=torch.long)
-    all_seq_len = torch.tensor([[f.seq_len] for f in test_features], dtype=torch.long)
-    all_context_ids = torch.tensor([f.context_ids for f in test_features], dtype=torch.long)
-
-    test_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                all_label_ids, all_seq_len, all_context_ids)
-    test_dataloader = DataLoader(test_data, shuffle=False)
+                                init_lrp=False, quantized=args.quantized)
 
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
@@ -253,42 +232,26 @@ def data_and_model_loader(device, n_gpu, args):
         model = torch.nn.DataParallel(model)
     model.to(device)
 
-    return model, test_dataloader
+    detector = AspectDetector(model, tokenizer, device,
+                              max_seq_length=args.max_seq_length,
+                              context_standalone=args.context_standalone,
+                              batch_size=args.eval_batch_size,
+                              precision=args.precision,
+                              compiled=args.compiled)
+    return detector
+
 
+def get_test_sentences(path):
+    # the input file lists every sentence once per aspect, as (aspect, sentence)
+    test_data = pd.read_csv(path, header=None)
+    return test_data.iloc[::len(context_id_map_fiqa), 1].tolist()
 
 
 def pred(args):
     device, n_gpu = system_setups(args)
-    model, test_dataloader = data_and_model_loader(device, n_gpu, args)
-
-    model.eval()
-    y_pred = []
-    for batch in list(test_dataloader):
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        input_ids, input_mask, segment_ids, label_ids, seq_lens, context_ids = batch
-        max_seq_lens = max(seq_lens)[0]
-        input_ids = input_ids[:, :max_seq_lens]
-        input_mask = input_mask[:, :max_seq_lens]
-        segment_ids = segment_ids[:, :max_seq_lens]
-
-        input_ids = input_ids.to(device)
-        input_mask = input_mask.to(device)
-        segment_ids = segment_ids.to(device)
-        label_ids = label_ids.to(device)
-        seq_lens = seq_lens.to(device)
-        context_ids = context_ids.to(device)
-
-        _, logits, _, _, _, _ = \
-            model(input_ids, segment_ids, input_mask, seq_lens,
-                  device=device, labels=label_ids,
-                  context_ids=context_ids)
-        logits = F.softmax(logits, dim=-1)
-        logits = logits.detach().cpu().numpy()
-        outputs = np.argmax(logits, axis=1)
-        y_pred.append(outputs[0])
-
-    return y_pred
+    detector = data_and_model_loader(device, n_gpu, args)
+    sentences = get_test_sentences(args.path)
+    return sentences, detector.predict(sentences)
 
 
 if __name__ == '__main__':
@@ -296,6 +259,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--path")
     parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--eval_batch_size", default=256, type=int)
     parser.add_argument("--vocab_file")
     parser.add_argument("--bert_config_file")
     parser.add_argument("--init_checkpoint")
@@ -303,18 +267,21 @@ if __name__ == '__main__':
     parser.add_argument("--no_cuda", default=False, action='store_true')
     parser.add_argument("--max_context_length", default=1, type=int)
     parser.add_argument("--context_standalone", default=False, action='store_true')
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16"])
+    parser.add_argument("--compiled", default=False, action='store_true',
+                        help="run a torch.compile graph per bucket of sequence lengths")
+    parser.add_argument("--quantized", default=False, action='store_true',
+                        help="init_checkpoint holds int8 weights from quantize_checkpoint.py")
     parser.add_argument('--seed', type=int, default=123)
     args = parser.parse_args()
 
-    pred_results = pred(args)
+    sentences, decisions = pred(args)
     acd_out = []
-    test_data = pd.read_csv(args.path, header=None)
-    for i in range(int(len(pred_results)/16)):
-        print(i)
-        for j in range(16):
-            if pred_results[j + i * 16] == 0:
-                tmp = [test_data.iloc[i * 16, 1], list(context_id_map_fiqa)[j]]
-                print(tmp)
-                acd_out.append(tmp)
+    aspects = list(context_id_map_fiqa)
+    for sentence, row in zip(sentences, decisions):
+        for j in np.flatnonzero(row):
+            tmp = [sentence, aspects[j]]
+            print(tmp)
+            acd_out.append(tmp)
     df_out = pd.DataFrame(acd_out)
     df_out.to_csv('acd_out.csv', index=None, header=None)
@@ -0,0 +1,638 @@
+"""Micro-benchmarks for the context-aware BERT models.
+
+Each sub-command measures one part of the pipeline. The model benchmarks
+run on synthetic inputs, so they need no dataset or pretrained checkpoint, e.g.
+
+    python benchmark.py attention_memory --batch_size 64 --max_seq_length 128
+    python benchmark.py --model_type CGBERT layer_latency --num_iters 20
+    python benchmark.py op_latency
+    python benchmark.py --model_type CGBERT optimizer_step
+    python benchmark.py --batch_size 64 checkpointing --checkpoint_every 0 1 4 12
+    python benchmark.py --batch_size 1 export_latency --onnx
+    python benchmark.py compiled_inference --buckets 32 64 96 128
+    python benchmark.py tokenizer --vocab_file vocab.txt
+    python benchmark.py features --vocab_file vocab.txt --max_workers 8
+    python benchmark.py --bert_config_file bert_config.json padding --vocab_file vocab.txt
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data.sampler import BatchSampler, SequentialSampler, WeightedRandomSampler
+
+from model.QACGBERT import BertConfig, BERTLayerNorm, QACGBertForSequenceClassification, gelu
+from model.CGBERT import CGBertForSequenceClassification
+from util.compiled import BucketedModel, compiled_graphs
+from util.data import BucketBatchSampler, FeatureBatchDataset, PaddingStats, \
+    batch_to_device
+from util.export import InferenceModel, max_abs_diff, onnx_session, random_inputs, \
+    to_onnx, to_torchscript
+from util.features import convert_examples_to_features
+from util.optimization import BERTAdam
+from util.tokenization import FullTokenizer, FastFullTokenizer
+from util.train_helper import processors, get_context_id_map, \
+    make_weights_for_balanced_classes
+
+
+def get_config(args):
+    if args.bert_config_file is not None:
+        return BertConfig.from_json_file(args.bert_config_file)
+    # BERT-Base, uncased
+    return BertConfig(vocab_size=30522, type_vocab_size=2)
+
+
+def get_model(args, config, num_labels=3):
+    if args.model_type == "CGBERT":
+        return CGBertForSequenceClassification(config, num_labels, init_weight=True)
+    return QACGBertForSequenceClassification(config, num_labels, init_weight=True)
+
+
+def random_batch(config, batch_size, seq_len, num_labels=3, num_contexts=8):
+    input_ids = torch.randint(1, config.vocab_size, (batch_size, seq_len))
+    input_mask = torch.ones(batch_size, seq_len, dtype=torch.long)
+    segment_ids = torch.zeros(batch_size, seq_len, dtype=torch.long)
+    label_ids = torch.randint(0, num_labels, (batch_size,))
+    seq_lens = torch.full((batch_size, 1), seq_len, dtype=torch.long)
+    context_ids = torch.randint(0, num_contexts, (batch_size, 1))
+    return input_ids, input_mask, segment_ids, label_ids, seq_lens, context_ids
+
+
+def _storage_key(tensor):
+    storage = tensor.untyped_storage()
+    return storage.data_ptr(), storage.nbytes()
+
+
+def activation_bytes(model, fn):
+    """Runs `fn` and returns the bytes held by the autograd graph and its outputs.
+
+    On CPU there is no allocator high-water mark, so we count every distinct
+    storage saved for backward plus every tensor returned by `fn`, leaving
+    out the weights of `model`; on CUDA the allocator peak is reported as well.
+    """
+    weights = set(_storage_key(p) for p in model.parameters())
+    storages = {}
+
+    def pack(tensor):
+        key = _storage_key(tensor)
+        if key not in weights:
+            storages[key] = key[1]
+        return tensor
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        outputs = fn()
+    for output in outputs:
+        tensors = output if isinstance(output, (list, tuple)) else [output]
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor):
+                key = _storage_key(tensor)
+                storages[key] = key[1]
+    cuda_peak = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+    return sum(storages.values()), cuda_peak
+
+
+def attention_memory(args):
+    """Memory held by a forward pass with and without the attention maps,
+    and without them with and without the chunked quasi-attention, whose
+    blocks are also run recomputed in the backward pass."""
+    config = get_config(args)
+    model = get_model(args, config)
+    batch = random_batch(config, args.batch_size, args.max_seq_length)
+    input_ids, input_mask, segment_ids, label_ids, seq_lens, context_ids = batch
+
+    settings = [(True, 0, False), (False, 0, False)]
+    if args.model_type == "QACGBERT":
+        settings += [(False, args.attention_chunk_size, False),
+                     (False, args.attention_chunk_size, True)]
+    for training in [True, False]:
+        model.train(training)
+        for output_attentions, chunk_size, checkpoint_attention in settings:
+            if not training and checkpoint_attention:
+                continue
+            for layer in model.bert.encoder.layer:
+                layer.attention.self.attention_chunk_size = chunk_size
+                layer.attention.self.checkpoint_attention = checkpoint_attention
+            def step():
+                return model(input_ids, segment_ids, input_mask, seq_lens,
+                             labels=label_ids, context_ids=context_ids,
+                             output_attentions=output_attentions)
+            with torch.set_grad_enabled(training):
+                held, cuda_peak = activation_bytes(model, step)
+            print("%s output_attentions=%s%s%s: %.1f MiB held%s" % (
+                "train" if training else "eval", output_attentions,
+                " attention_chunk_size=%d" % chunk_size if chunk_size else "",
+                " checkpoint_attention" if checkpoint_attention else "",
+                held / 2**20,
+                "" if cuda_peak is None else ", %.1f MiB cuda peak" % (cuda_peak / 2**20)))
+
+
+def layer_latency(args):
+    """Latency of one encoder layer, forward only in eval and forward plus
+    backward in training."""
+    config = get_config(args)
+    model = get_model(args, config)
+    layer = model.bert.encoder.layer[0]
+    shape = (args.batch_size, args.max_seq_length, config.hidden_size)
+    hidden_states = torch.randn(shape)
+    context_embedded = torch.randn(shape)
+    attention_mask = torch.zeros(args.batch_size, 1, 1, args.max_seq_length)
+
+    def forward():
+        output = layer(hidden_states, attention_mask, context_embedded=context_embedded)
+        return output[0] if isinstance(output, tuple) else output
+
+    for training in [False, True]:
+        layer.train(training)
+        hidden_states.requires_grad_(training)
+        with torch.set_grad_enabled(training):
+            timings = []
+            for i in range(args.num_iters + 1):
+                start = time.time()
+                output = forward()
+                if training:
+                    output.sum().backward()
+                # the first iteration is a warm-up
+                if i > 0:
+                    timings.append(time.time() - start)
+        print("%s %s: %.2f ms per layer" % (
+            args.model_type, "train" if training else "eval",
+            sorted(timings)[len(timings) // 2] * 1000))
+
+
+def export_latency(args):
+    """Inference latency of the eager model against its TorchScript and,
+    with --onnx, its ONNX Runtime export, on CPU."""
+    config = get_config(args)
+    model = get_model(args, config).eval()
+    inputs = random_inputs(model, args.batch_size, args.max_seq_length)
+    runners = [("eager", InferenceModel(model).eval()),
+               ("torchscript", to_torchscript(model, random_inputs(model, 2, 16)))]
+    if args.onnx:
+        onnx_path = os.path.join(tempfile.mkdtemp(), "model.onnx")
+        to_onnx(model, random_inputs(model, 2, 16), onnx_path)
+        runners.append(("onnxruntime", onnx_session(onnx_path)))
+
+    for name, run in runners:
+        with torch.no_grad():
+            timings = []
+            for i in range(args.num_iters + 3):
+                start = time.time()
+                run(*inputs)
+                # warm-ups, TorchScript optimizes the graph over its first runs
+                if i > 2:
+                    timings.append(time.time() - start)
+        diff = max_abs_diff(model, run, [inputs])
+        print("%s %s: %.2f ms per batch, max difference to eager %.1e" % (
+            args.model_type, name, sorted(timings)[len(timings) // 2] * 1000, diff))
+
+
+def compiled_inference(args):
+    """Eager inference on batches trimmed to their longest sequence against
+    the compiled model padded to length buckets: compile time, steady-state
+    latency and the graphs compiled after the warm-up."""
+    config = get_config(args)
+    model = get_model(args, config).eval()
+    # batches of random lengths, as the trimming leaves them
+    batches = [random_inputs(model, args.batch_size, int(seq_length))
+               for seq_length in torch.randint(8, args.max_seq_length + 1, (args.num_iters,))]
+
+    buckets = [b for b in args.buckets if b < args.max_seq_length] + [args.max_seq_length]
+    bucketed = BucketedModel(model, "cpu", args.batch_size, buckets)
+    bucketed.warmup()
+    for seq_length, seconds in sorted(bucketed.compile_time.items()):
+        print("%s compile, length %d: %.1f s" % (args.model_type, seq_length, seconds))
+    graphs = compiled_graphs()
+
+    eager = InferenceModel(model).eval()
+    for name, run in [("eager", eager), ("compiled", bucketed)]:
+        timings = []
+        with torch.inference_mode():
+            for inputs in batches:
+                start = time.time()
+                run(*inputs)
+                timings.append(time.time() - start)
+        print("%s %s: %.2f ms per batch" % (
+            args.model_type, name, sorted(timings)[len(timings) // 2] * 1000))
+    print("%s recompiles after warm-up: %d" % (args.model_type, compiled_graphs() - graphs))
+
+
+def op_latency(args):
+    """BERTLayerNorm and gelu against the composite expressions they used to
+    be, on one batch of hidden states: the largest difference and the
+    latency forward and forward plus backward."""
+    config = get_config(args)
+    layer_norm = BERTLayerNorm(config)
+    layer_norm.gamma.data.normal_()
+    layer_norm.beta.data.normal_()
+
+    def composite_layer_norm(x):
+        u = x.mean(-1, keepdim=True)
+        s = (x - u).pow(2).mean(-1, keepdim=True)
+        x = (x - u) / torch.sqrt(s + layer_norm.variance_epsilon)
+        return layer_norm.gamma * x + layer_norm.beta
+
+    def composite_gelu(x):
+        return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
+
+    ops = [("layer_norm", composite_layer_norm, layer_norm, config.hidden_size),
+           ("gelu", composite_gelu, gelu, config.intermediate_size)]
+    for name, composite, fused, size in ops:
+        x = torch.randn(args.batch_size, args.max_seq_length, size)
+        diff = (composite(x) - fused(x)).abs().max().item()
+        latencies = []
+        for fn in [composite, fused]:
+            for training in [False, True]:
+                x.requires_grad_(training)
+                with torch.set_grad_enabled(training):
+                    timings = []
+                    for i in range(args.num_iters + 1):
+                        start = time.time()
+                        output = fn(x)
+                        if training:
+                            output.sum().backward()
+                        # the first iteration is a warm-up
+                        if i > 0:
+                            timings.append(time.time() - start)
+                latencies.append(sorted(timings)[len(timings) // 2] * 1000)
+        print("%s: forward %.2f -> %.2f ms (%.1fx), forward+backward %.2f -> %.2f ms (%.1fx), "
+              "max difference %.1e" % (
+                  name, latencies[0], latencies[2], latencies[0] / latencies[2],
+                  latencies[1], latencies[3], latencies[1] / latencies[3], diff))
+
+
+def optimizer_step(args):
+    """Latency of one BERTAdam step over all the parameters of the model,
+    one parameter at a time against multi-tensor, with either clipping and
+    each way of storing the moments, and the memory of the moments."""
+    config = get_config(args)
+    model = get_model(args, config)
+    no_decay = ['bias', 'gamma', 'beta']
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+
+    settings = [(per_param_clip, foreach, "fp32")
+                for per_param_clip in [True, False] for foreach in [False, True]]
+    settings += [(False, foreach, state_dtype)
+                 for state_dtype in ["bf16", "int8"] for foreach in [False, True]]
+    for per_param_clip, foreach, state_dtype in settings:
+        optimizer = BERTAdam(
+            [{'params': [p for n, p in model.named_parameters()
+                         if not any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.01},
+             {'params': [p for n, p in model.named_parameters()
+                         if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}],
+            lr=2e-5, warmup=0.1, t_total=1000,
+            per_param_clip=per_param_clip, foreach=foreach, state_dtype=state_dtype)
+        timings = []
+        for i in range(args.num_iters + 1):
+            start = time.time()
+            optimizer.step()
+            # the first iteration is a warm-up
+            if i > 0:
+                timings.append(time.time() - start)
+        state_bytes = sum(v.numel() * v.element_size() for state in optimizer.state.values()
+                          for v in state.values() if torch.is_tensor(v))
+        print("%s %s clip, %s, %s state: %.2f ms per step, %.1f MB of state" % (
+            args.model_type, "per-parameter" if per_param_clip else "global",
+            "foreach" if foreach else "single tensor", state_dtype,
+            sorted(timings)[len(timings) // 2] * 1000, state_bytes / 2 ** 20))
+
+
+def _proc_status_kib(field):
+    with open("/proc/self/status") as reader:
+        for line in reader:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+
+def peak_rss_bytes(fn):
+    """Runs `fn` and returns how far the resident set size peaked above its
+    size before the call. Relies on Linux's /proc/self/clear_refs to reset
+    the high-water mark."""
+    with open("/proc/self/clear_refs", "w") as writer:
+        writer.write("5")
+    start = _proc_status_kib("VmRSS")
+    fn()
+    return (_proc_status_kib("VmHWM") - start) * 1024
+
+
+def _checkpointing_step(args, checkpoint_every):
+    config = get_config(args)
+    config.checkpoint_every = checkpoint_every
+    torch.manual_seed(123)
+    model = get_model(args, config)
+    model.train()
+    batch = random_batch(config, args.batch_size, args.max_seq_length)
+    input_ids, input_mask, segment_ids, label_ids, seq_lens, context_ids = batch
+
+    def step():
+        loss = model(input_ids, segment_ids, input_mask, seq_lens,
+                     labels=label_ids, context_ids=context_ids)[0]
+        loss.backward()
+        model.zero_grad()
+
+    # the first step is measured before the allocator caches anything,
+    # it also allocates the gradients
+    peak = peak_rss_bytes(step)
+    timings = []
+    for _ in range(args.num_iters):
+        start = time.time()
+        step()
+        timings.append(time.time() - start)
+    return peak, sorted(timings)[len(timings) // 2]
+
+
+def checkpointing(args):
+    """Peak memory and time of a training step for each checkpoint_every.
+
+    Every setting runs in a fresh process, so that memory freed by one does
+    not hide the peak of the next.
+    """
+    context = multiprocessing.get_context("spawn")
+    for checkpoint_every in args.checkpoint_every:
+        with context.Pool(1) as pool:
+            peak, step_time = pool.apply(_checkpointing_step, (args, checkpoint_every))
+        print("%s checkpoint_every=%d: %.1f MiB peak, %.2f s per step" % (
+            args.model_type, checkpoint_every, peak / 2**20, step_time))
+
+
+# task name and data directory of each training set
+corpora = {
+    "sentihood": ("sentihood_NLI_M", "sentihood"),
+    "semeval": ("semeval_NLI_M", "semeval2014"),
+    "fiqa": ("fiqa_acd", os.path.join("FIQA", "FiQA_ABSA_task1")),
+}
+
+
+def get_examples(args, corpus):
+    task_name, data_dir = corpora[corpus]
+    processor = processors[task_name]()
+    return processor.get_train_examples(os.path.join(args.data_dir, data_dir))
+
+
+def tokenizer_throughput(args):
+    """Tokenization throughput of FullTokenizer and FastFullTokenizer."""
+    tokenizers = [
+        ("FullTokenizer", FullTokenizer(args.vocab_file, pretrain=False)),
+        ("FastFullTokenizer", FastFullTokenizer(args.vocab_file, pretrain=False)),
+    ]
+    for corpus in ["sentihood", "fiqa"]:
+        examples = get_examples(args, corpus)
+        texts = [example.text_a for example in examples] + \
+            [example.text_b for example in examples]
+        outputs = []
+        for name, tokenizer in tokenizers:
+            # the character class tables are built on first use
+            tokenizer.tokenize(texts[0])
+            start = time.time()
+            output = [tokenizer.tokenize(text) for text in texts]
+            elapsed = time.time() - start
+            outputs.append(output)
+            print("%s %s: %d texts, %.0f texts/s, %.0f tokens/s" % (
+                corpus, name, len(texts), len(texts) / elapsed,
+                sum(len(tokens) for tokens in output) / elapsed))
+        if outputs[0] != outputs[1]:
+            raise ValueError("FastFullTokenizer output differs on %s" % corpus)
+
+
+def feature_conversion(args):
+    """Feature conversion time for an increasing number of worker processes."""
+    tokenizer = FastFullTokenizer(args.vocab_file, pretrain=False)
+    for corpus in ["semeval", "fiqa"]:
+        task_name = corpora[corpus][0]
+        examples = get_examples(args, corpus)
+        label_map = {label: i for i, label in
+                     enumerate(processors[task_name]().get_labels())}
+        baseline = None
+        num_workers = 1
+        while num_workers <= args.max_workers:
+            start = time.time()
+            features = convert_examples_to_features(
+                examples, args.max_seq_length, tokenizer, 1, False,
+                get_context_id_map(task_name), label_map=label_map,
+                num_workers=num_workers)
+            elapsed = time.time() - start
+            baseline = baseline or elapsed
+            print("%s num_workers=%d: %d examples in %.2fs, %.2fx" % (
+                corpus, num_workers, len(examples), elapsed, baseline / elapsed))
+            num_workers *= 2
+        print("%s: %.1f MiB resident, %.1f MiB as int64" % (
+            corpus, sum(array.nbytes for array in features) / 2**20,
+            sum(array.size * 8 for array in features) / 2**20))
+
+
+def padding(args):
+    """Padding ratio and training throughput with and without length bucketing.
+
+    The batches are drawn with the class-balanced sampler of the training
+    loop; throughput is measured on the first `num_batches` batches.
+    """
+    tokenizer = FastFullTokenizer(args.vocab_file, pretrain=False)
+    config = get_config(args)
+    config.vocab_size = len(tokenizer.vocab)
+    for corpus in ["sentihood", "fiqa"]:
+        task_name = corpora[corpus][0]
+        examples = get_examples(args, corpus)
+        # the labels are only used for the class balancing
+        label_map = {label: i for i, label in
+                     enumerate(sorted(set(example.label for example in examples)))}
+        features = [torch.from_numpy(array) for array in convert_examples_to_features(
+            examples, args.max_seq_length, tokenizer, 1, False,
+            get_context_id_map(task_name), label_map=label_map)]
+        data = FeatureBatchDataset(*features)
+        label_ids, seq_lens = features[3], features[4]
+        weights = make_weights_for_balanced_classes(label_ids, len(label_map))
+        sampler = WeightedRandomSampler(weights, len(data), replacement=True)
+
+        model = get_model(args, config, num_labels=len(label_map))
+        model.train()
+        for bucket_size in [0, args.bucket_size]:
+            if bucket_size > 0:
+                batch_sampler = BucketBatchSampler(sampler, seq_lens, args.batch_size,
+                                                   bucket_size=bucket_size)
+            else:
+                batch_sampler = BatchSampler(sampler, args.batch_size, drop_last=False)
+            loader = DataLoader(data, sampler=batch_sampler, batch_size=None)
+            epoch_stats = PaddingStats()
+            for input_ids, _, _, _, batch_seq_lens, _ in loader:
+                epoch_stats.update(input_ids, batch_seq_lens)
+
+            step_stats = PaddingStats()
+            start = time.time()
+            for step, batch in enumerate(loader):
+                if step == args.num_batches:
+                    break
+                input_ids, input_mask, segment_ids, label_ids, batch_seq_lens, \
+                    context_ids = batch_to_device(batch, "cpu")
+                step_stats.update(input_ids, batch_seq_lens)
+                loss = model(input_ids, segment_ids, input_mask, batch_seq_lens,
+                             labels=label_ids, context_ids=context_ids)[0]
+                loss.backward()
+                model.zero_grad()
+            print("%s bucket_size=%d: padding ratio %.3f (vs %.3f at max_seq_length), "
+                  "%.0f tokens/s" % (
+                      corpus, bucket_size, epoch_stats.padding_ratio,
+                      1.0 - epoch_stats.tokens / (len(data) * args.max_seq_length),
+                      step_stats.tokens / (time.time() - start)))
+
+
+def loading(args):
+    """Time per batch spent loading the data, without any model.
+
+    Compares per-example indexing of a `TensorDataset` with default
+    collation and trimming, as the loaders used to do, to gathering whole
+    batches from a `FeatureBatchDataset`.
+    """
+    tokenizer = FastFullTokenizer(args.vocab_file, pretrain=False)
+    for corpus in ["sentihood", "fiqa"]:
+        task_name = corpora[corpus][0]
+        examples = get_examples(args, corpus)
+        label_map = {label: i for i, label in
+                     enumerate(sorted(set(example.label for example in examples)))}
+        features = [torch.from_numpy(array) for array in convert_examples_to_features(
+            examples, args.max_seq_length, tokenizer, 1, False,
+            get_context_id_map(task_name), label_map=label_map)]
+
+        def per_example():
+            loader = DataLoader(TensorDataset(*features), batch_size=args.batch_size)
+            for batch in loader:
+                input_ids, input_mask, segment_ids, label_ids, seq_lens, \
+                    context_ids = batch
+                max_seq_lens = max(seq_lens)[0]
+                input_ids = input_ids[:,:max_seq_lens]
+                input_mask = input_mask[:,:max_seq_lens]
+                segment_ids = segment_ids[:,:max_seq_lens]
+                yield batch_to_device((input_ids, input_mask, segment_ids, label_ids,
+                                       seq_lens, context_ids), "cpu")
+
+        def batched():
+            data = FeatureBatchDataset(*features)
+            batch_sampler = BatchSampler(SequentialSampler(data), args.batch_size,
+                                         drop_last=False)
+            for batch in DataLoader(data, sampler=batch_sampler, batch_size=None):
+                yield batch_to_device(batch, "cpu")
+
+        for name, batches in [("TensorDataset", per_example), ("FeatureBatchDataset", batched)]:
+            start = time.time()
+            n_batches = sum(1 for _ in batches())
+            print("%s %s: %.3f ms per batch of %d" % (
+                corpus, name, (time.time() - start) / n_batches * 1000, args.batch_size))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--bert_config_file",
+                    default=None,
+                    type=str,
+                    help="The config json file of the model to benchmark, BERT-Base by default.")
+parser.add_argument("--model_type",
+                    default="QACGBERT",
+                    choices=["CGBERT", "QACGBERT"],
+                    help="type of model to benchmark")
+parser.add_argument("--batch_size",
+                    default=32,
+                    type=int,
+                    help="Batch size of the synthetic inputs.")
+parser.add_argument("--max_seq_length",
+                    default=128,
+                    type=int,
+                    help="Sequence length of the synthetic inputs.")
+subparsers = parser.add_subparsers(dest="benchmark")
+subparsers.required = True
+memory_parser = subparsers.add_parser("attention_memory")
+memory_parser.add_argument("--attention_chunk_size",
+                           default=128,
+                           type=int,
+                           help="Number of queries the chunked quasi-attention attends to at a time.")
+memory_parser.set_defaults(func=attention_memory)
+layer_parser = subparsers.add_parser("layer_latency")
+layer_parser.add_argument("--num_iters",
+                          default=20,
+                          type=int,
+                          help="Number of timed iterations, the median is reported.")
+layer_parser.set_defaults(func=layer_latency)
+op_parser = subparsers.add_parser("op_latency")
+op_parser.add_argument("--num_iters",
+                       default=20,
+                       type=int,
+                       help="Number of timed iterations, the median is reported.")
+op_parser.set_defaults(func=op_latency)
+optimizer_parser = subparsers.add_parser("optimizer_step")
+optimizer_parser.add_argument("--num_iters",
+                              default=10,
+                              type=int,
+                              help="Number of timed steps, the median is reported.")
+optimizer_parser.set_defaults(func=optimizer_step)
+checkpointing_parser = subparsers.add_parser("checkpointing")
+checkpointing_parser.add_argument("--checkpoint_every",
+                                  default=[0, 1, 2, 4],
+                                  type=int,
+                                  nargs="+",
+                                  help="The checkpoint_every settings to compare.")
+checkpointing_parser.add_argument("--num_iters",
+                                  default=3,
+                                  type=int,
+                                  help="Number of timed steps, the median is reported.")
+checkpointing_parser.set_defaults(func=checkpointing)
+export_parser = subparsers.add_parser("export_latency")
+export_parser.add_argument("--num_iters",
+                           default=20,
+                           type=int,
+                           help="Number of timed iterations, the median is reported.")
+export_parser.add_argument("--onnx",
+                           action="store_true",
+                           help="Also time the ONNX export under ONNX Runtime.")
+export_parser.set_defaults(func=export_latency)
+compiled_parser = subparsers.add_parser("compiled_inference")
+compiled_parser.add_argument("--buckets",
+                             default=[32, 64, 96, 128],
+                             type=int,
+                             nargs="+",
+                             help="Sequence lengths the compiled model pads the batches to.")
+compiled_parser.add_argument("--num_iters",
+                             default=20,
+                             type=int,
+                             help="Number of timed batches, the median is reported.")
+compiled_parser.set_defaults(func=compiled_inference)
+# options of the benchmarks running on the datasets
+data_parser = argparse.ArgumentParser(add_help=False)
+data_parser.add_argument("--vocab_file",
+                         required=True,
+                         type=str,
+                         help="The vocabulary file that the BERT model was trained on.")
+data_parser.add_argument("--data_dir",
+                         default=os.path.join("..", "datasets"),
+                         type=str,
+                         help="The directory holding the sentihood, semeval2014 and FIQA datasets.")
+tokenizer_parser = subparsers.add_parser("tokenizer", parents=[data_parser])
+tokenizer_parser.set_defaults(func=tokenizer_throughput)
+features_parser = subparsers.add_parser("features", parents=[data_parser])
+features_parser.add_argument("--max_workers",
+                             default=os.cpu_count(),
+                             type=int,
+                             help="Largest number of processes to convert with.")
+features_parser.set_defaults(func=feature_conversion)
+padding_parser = subparsers.add_parser("padding", parents=[data_parser])
+padding_parser.add_argument("--bucket_size",
+                            default=100,
+                            type=int,
+                            help="Number of batches pooled and sorted by length.")
+padding_parser.add_argument("--num_batches",
+                            default=20,
+                            type=int,
+                            help="Number of training steps to measure the throughput on.")
+padding_parser.set_defaults(func=padding)
+subparsers.add_parser("loading", parents=[data_parser]).set_defaults(func=loading)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    torch.manual_seed(123)
+    args.func(args)
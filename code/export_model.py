@@ -0,0 +1,121 @@
+# coding=utf-8
+
+"""Export a fine-tuned checkpoint for inference.
+
+The model is traced into TorchScript and, optionally, exported to ONNX,
+both with the signature (input_ids, segment_ids, input_mask, context_ids)
+-> logits (or score) and dynamic batch and sequence axes. The exported
+models are checked against the eager model on random inputs of several
+shapes before they are written.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+
+import torch
+
+from model.QACGBERT import BertConfig, QACGBertForSequenceClassification, \
+    QACGBertForSequenceScore
+from model.CGBERT import BertConfig as CGBertConfig, CGBertForSequenceClassification
+from util.checkpoint import build_from_checkpoint
+from util.export import max_abs_diff, onnx_session, random_inputs, to_onnx, \
+    to_torchscript
+
+parser = argparse.ArgumentParser()
+
+## Required parameters
+parser.add_argument("--model_type",
+                    default = "QACGBERT",
+                    choices = ["QACGBERT", "QACGBERT_score", "CGBERT"],
+                    help = "QACGBertForSequenceClassification, QACGBertForSequenceScore or "
+                        "CGBertForSequenceClassification.")
+parser.add_argument("--bert_config_file",
+                    default = None,
+                    type = str,
+                    required = True,
+                    help = "The config json file corresponding to the pre-trained BERT model. \n"
+                        "This specifies the model architecture.")
+parser.add_argument("--vocab_size",
+                    default = None,
+                    type = int,
+                    required = True,
+                    help = "Number of lines of the vocab file the model was fine-tuned with.")
+parser.add_argument("--init_checkpoint",
+                    default = None,
+                    type = str,
+                    required = True,
+                    help = "The fine-tuned checkpoint, e.g. best_checkpoint.bin.")
+parser.add_argument("--torchscript_path",
+                    default = None,
+                    type = str,
+                    required = True,
+                    help = "Where to write the TorchScript model.")
+
+## Other parameters
+parser.add_argument("--onnx_path",
+                    default = None,
+                    type = str,
+                    help = "Where to write the ONNX model, if at all.")
+parser.add_argument("--num_labels",
+                    default = 2,
+                    type = int,
+                    help = "Number of classes of the classification models.")
+parser.add_argument("--max_seq_length",
+                    default = 128,
+                    type = int,
+                    help = "The longest inputs to check the exported models on.")
+parser.add_argument("--tolerance",
+                    default = 1e-4,
+                    type = float,
+                    help = "Largest output difference to the eager model that is accepted.")
+
+args = parser.parse_args()
+
+
+def load_model():
+    if args.model_type == "CGBERT":
+        config = CGBertConfig.from_json_file(args.bert_config_file)
+        config.vocab_size = args.vocab_size
+        build = lambda: CGBertForSequenceClassification(config, args.num_labels)
+    else:
+        config = BertConfig.from_json_file(args.bert_config_file)
+        config.vocab_size = args.vocab_size
+        if args.model_type == "QACGBERT_score":
+            build = lambda: QACGBertForSequenceScore(config)
+        else:
+            build = lambda: QACGBertForSequenceClassification(config, args.num_labels)
+    return build_from_checkpoint(build, args.init_checkpoint).eval()
+
+
+def check(model, exported, name):
+    # single rows, odd lengths and full length batches
+    batches = [random_inputs(model, 1, 8), random_inputs(model, 3, 37),
+               random_inputs(model, 8, args.max_seq_length)]
+    diff = max_abs_diff(model, exported, batches)
+    print("{}: max difference to eager = {:.2e}".format(name, diff))
+    if diff > args.tolerance:
+        raise ValueError("The {} model differs from the eager model by {:.2e}".format(name, diff))
+
+
+def export():
+    model = load_model()
+    # no longer than attention_chunk_size, so the trace attends in one block
+    example_inputs = random_inputs(model, 2, 16)
+
+    traced = to_torchscript(model, example_inputs)
+    check(model, traced, "TorchScript")
+    print("Saving the TorchScript model to {}".format(args.torchscript_path))
+    torch.jit.save(traced, args.torchscript_path)
+
+    if args.onnx_path is not None:
+        print("Saving the ONNX model to {}".format(args.onnx_path))
+        to_onnx(model, example_inputs, args.onnx_path)
+        try:
+            check(model, onnx_session(args.onnx_path), "ONNX")
+        except ImportError:
+            print("onnxruntime is not installed, the ONNX model is not checked")
+
+
+if __name__ == "__main__":
+    export()
@@ -14,6 +14,7 @@ import six
 import torch
 import torch.nn as nn
 from torch.nn import CrossEntropyLoss
+import torch.nn.functional as F
 
 
 def gelu(x):
@@ -21,7 +22,7 @@ def gelu(x):
         For information: OpenAI GPT's gelu is slightly different (and gives slightly different results):
         0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
     """
-    return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
+    return F.gelu(x)
 
 
 class BertConfig(object):
@@ -109,10 +110,10 @@ class BERTLayerNorm(nn.Module):
         self.variance_epsilon = variance_epsilon
 
     def forward(self, x):
-        u = x.mean(-1, keepdim=True)
-        s = (x - u).pow(2).mean(-1, keepdim=True)
-        x = (x - u) / torch.sqrt(s + self.variance_epsilon)
-        return self.gamma * x + self.beta
+        # the fused kernel is TF style too: biased variance, epsilon inside
+        # the square root
+        return F.layer_norm(x, self.gamma.shape, self.gamma, self.beta,
+                            self.variance_epsilon)
 
 class BERTEmbeddings(nn.Module):
     def __init__(self, config):
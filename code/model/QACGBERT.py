@@ -12,6 +12,7 @@ import torch.nn as nn
 from torch.nn import CrossEntropyLoss, MSELoss
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
 
 import collections
 from functools import partial
@@ -59,7 +60,7 @@ def gelu(x):
         For information: OpenAI GPT's gelu is slightly different (and gives slightly different results):
         0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
     """
-    return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
+    return F.gelu(x)
 
 class BERTIntermediate(nn.Module):
     def __init__(self, config):
@@ -87,7 +88,10 @@ class BertConfig(object):
                 max_position_embeddings=512,
                 type_vocab_size=16,
                 initializer_range=0.02,
-                full_pooler=False): # this is for transformer-like BERT
+                full_pooler=False, # this is for transformer-like BERT
+                attention_chunk_size=128,
+                checkpoint_attention=False,
+                checkpoint_every=0):
         """Constructs BertConfig.
 
         Args:
@@ -111,6 +115,15 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            attention_chunk_size: The number of queries the quasi-attention is
+                computed for at a time when the attention maps are not returned.
+                0 computes it for all queries at once.
+            checkpoint_attention: In training, the blocks of the chunked
+                quasi-attention are recomputed in the backward pass instead of
+                keeping their maps, trading compute for memory.
+            checkpoint_every: In training, the encoder layers are run in segments
+                of this many layers whose activations are recomputed in the
+                backward pass instead of kept. 0 keeps all of them.
         """
         self.vocab_size = vocab_size
         self.hidden_size = hidden_size
@@ -124,6 +137,9 @@ class BertConfig(object):
         self.type_vocab_size = type_vocab_size
         self.initializer_range = initializer_range
         self.full_pooler = full_pooler
+        self.attention_chunk_size = attention_chunk_size
+        self.checkpoint_attention = checkpoint_attention
+        self.checkpoint_every = checkpoint_every
 
     @classmethod
     def from_dict(cls, json_object):
@@ -160,10 +176,12 @@ class BERTLayerNorm(nn.Module):
         self.variance_epsilon = variance_epsilon
 
     def forward(self, x):
-        u = x.mean(-1, keepdim=True)
-        s = (x - u).pow(2).mean(-1, keepdim=True)
-        x = (x - u) / torch.sqrt(s + self.variance_epsilon)
-        return self.gamma * x + self.beta
+        # the statistics are taken in fp32, also under bf16 autocast
+        x = x.float()
+        # the fused kernel is TF style too: biased variance, epsilon inside
+        # the square root
+        return F.layer_norm(x, self.gamma.shape, self.gamma, self.beta,
+                            self.variance_epsilon)
 
 class BERTEmbeddings(nn.Module):
     def __init__(self, config):
@@ -195,6 +213,10 @@ class BERTEmbeddings(nn.Module):
         embeddings = self.dropout(embeddings)
         return embeddings
 
+def expand_aspect_groups(x, aspect_group_size):
+    """Repeats every row of a sentence-level tensor for each of its aspect variants."""
+    return x.repeat_interleave(aspect_group_size, dim=0)
+
 def mask(seq_len):
     batch_size = len(seq_len)
     max_len = max(seq_len)
@@ -238,6 +260,42 @@ class ContextBERTPooler(nn.Module):
         pooled_output = self.activation(pooled_output)
         return pooled_output
 
+def linear_weight_and_bias(linear):
+    """The weight and bias of `linear` as float tensors, also when it was
+    replaced by a dynamically quantized Linear (`util.precision.quantize`),
+    which keeps them packed in int8."""
+    if callable(linear.weight):
+        return linear.weight().dequantize(), linear.bias()
+    return linear.weight, linear.bias
+
+# packed parameters of ContextBERTSelfAttention and the separate layers
+# they are stacked from, in order
+packed_attention_params = collections.OrderedDict([
+    ("qkv", ["query", "key", "value"]),
+    ("context_qk", ["context_for_q", "context_for_k"]),
+    ("lambda_gates", ["lambda_q_context_layer", "lambda_q_query_layer",
+                      "lambda_k_context_layer", "lambda_k_key_layer"]),
+])
+
+def pack_legacy_state_dict(state_dict, prefix, packed_params):
+    """Stacks the weights and biases of separately stored layers under
+    `prefix` into their packed layer, in place, so that checkpoints saved
+    before the layers were packed still load. A packed layer is only
+    built when all of its parts are present."""
+    for packed, parts in packed_params.items():
+        for param in ["weight", "bias"]:
+            keys = [prefix + part + "." + param for part in parts]
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + packed + "." + param] = \
+                    torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+def mask_rows(attention_mask, start, end):
+    """The rows start:end of an attention mask, which is either broadcast
+    over the queries or holds one row per query."""
+    if attention_mask.size(-2) == 1:
+        return attention_mask
+    return attention_mask[..., start:end, :]
+
 class ContextBERTSelfAttention(nn.Module):
     def __init__(self, config):
         super(ContextBERTSelfAttention, self).__init__()
@@ -249,87 +307,151 @@ class ContextBERTSelfAttention(nn.Module):
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-        self.query = nn.Linear(config.hidden_size, self.all_head_size)
-        self.key = nn.Linear(config.hidden_size, self.all_head_size)
-        self.value = nn.Linear(config.hidden_size, self.all_head_size)
+        # query, key and value projections packed into one GEMM
+        self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
         # learnable context integration factors
         # enforce initialization to zero as to leave the pretrain model
         # unperturbed in the beginning
-        self.context_for_q = nn.Linear(config.hidden_size, config.hidden_size)
-        self.context_for_k = nn.Linear(config.hidden_size, config.hidden_size)
-        self.lambda_q_context_layer = nn.Linear(self.attention_head_size, 1)
-        self.lambda_q_query_layer = nn.Linear(self.attention_head_size, 1)
-        self.lambda_k_context_layer = nn.Linear(self.attention_head_size, 1)
-        self.lambda_k_key_layer = nn.Linear(self.attention_head_size, 1)
+        # context_for_q and context_for_k, packed
+        self.context_qk = nn.Linear(config.hidden_size, 2 * config.hidden_size)
+        # the rows are the lambda_q_context, lambda_q_query, lambda_k_context
+        # and lambda_k_key gates, each projecting a head to a scalar
+        self.lambda_gates = nn.Linear(self.attention_head_size, 4)
 
         # zero-centered activation function, specifically for re-arch fine tunning
         self.lambda_act = nn.Sigmoid()
         self.quasi_act = nn.Sigmoid()
 
+        self.attention_chunk_size = config.attention_chunk_size
+        self.checkpoint_attention = config.checkpoint_attention
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
+    def split_heads(self, x, n):
+        """Splits the output of a packed projection into its `n` parts, each
+        of shape [batch, heads, seq, head_size]."""
+        x = x.view(x.size()[:-1] + (n, self.num_attention_heads, self.attention_head_size))
+        return [x.select(2, i).permute(0, 2, 1, 3) for i in range(n)]
+
+    def gates(self, x, rows):
+        """Applies the lambda gates `rows` to the heads of a packed
+        projection, in one batched product. Returns one
+        [batch, heads, seq, 1] gate per row."""
+        x = x.view(x.size()[:-1] + (len(rows), self.num_attention_heads, self.attention_head_size))
+        weight, bias = linear_weight_and_bias(self.lambda_gates)
+        gates = torch.einsum("blghd,gd->bghl", x, weight[rows]) + bias[rows].view(-1, 1, 1)
+        return [gate.unsqueeze(-1) for gate in gates.unbind(1)]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        pack_legacy_state_dict(state_dict, prefix, packed_attention_params)
+        super(ContextBERTSelfAttention, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
     def forward(self, hidden_states, attention_mask,
                 # optional parameters for saving context information
-                device=None, context_embedded=None):
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(hidden_states)
-        mixed_value_layer = self.value(hidden_states)
-
-        ######################################################################
-        # Dot product attention
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-        key_layer = self.transpose_for_scores(mixed_key_layer)
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        attention_scores = attention_scores + attention_mask
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores) # [0, 1]
+                device=None, context_embedded=None,
+                aspect_group_size=None, output_attentions=False):
+        if aspect_group_size is not None:
+            # hidden_states only holds one row per sentence, while the context
+            # holds one row per aspect variant. Per-aspect tensors are viewed
+            # as (sentences, aspects, ...) and the sentence-level ones are
+            # broadcast over the aspect dimension.
+            group = lambda x: x.reshape((-1, aspect_group_size) + x.shape[1:])
+            ungroup = lambda x: x.reshape((-1,) + x.shape[2:])
+            share = lambda x: x.unsqueeze(1)
+            shared_attention_mask = attention_mask[::aspect_group_size]
+        else:
+            group = ungroup = share = lambda x: x
+            shared_attention_mask = attention_mask
+
+        mixed_layer = self.qkv(hidden_states)
+        query_layer, key_layer, value_layer = self.split_heads(mixed_layer, 3)
 
         # Quasi-attention Integration with context
-        context_embedded_q = self.context_for_q(context_embedded)
-        context_embedded_q = self.transpose_for_scores(context_embedded_q)
-        context_embedded_q = self.dropout(context_embedded_q)
-        context_embedded_k = self.context_for_k(context_embedded)
-        context_embedded_k = self.transpose_for_scores(context_embedded_k)
-        context_embedded_k = self.dropout(context_embedded_k)
-
-        quasi_attention_scores = torch.matmul(context_embedded_q, context_embedded_k.transpose(-1, -2))
-        quasi_attention_scores = quasi_attention_scores / math.sqrt(self.attention_head_size)
-        quasi_attention_scores = quasi_attention_scores + attention_mask
-        quasi_scalar = 1.0
-        quasi_attention_scores = 1.0 * quasi_scalar * self.quasi_act(quasi_attention_scores) # [-1, 0]
+        mixed_context_layer = self.dropout(self.context_qk(context_embedded))
+        context_embedded_q, context_embedded_k = self.split_heads(mixed_context_layer, 2)
 
         # Quasi-gated control
-        lambda_q_context = self.lambda_q_context_layer(context_embedded_q)
-        lambda_q_query = self.lambda_q_query_layer(query_layer)
-        lambda_q = self.quasi_act(lambda_q_context + lambda_q_query)
-        lambda_k_context = self.lambda_k_context_layer(context_embedded_k)
-        lambda_k_key = self.lambda_k_key_layer(key_layer)
-        lambda_k = self.quasi_act(lambda_k_context + lambda_k_key)
+        lambda_q_context, lambda_k_context = self.gates(mixed_context_layer, [0, 2])
+        lambda_q_query, lambda_k_key = self.gates(mixed_layer[..., :2 * self.all_head_size], [1, 3])
+        lambda_q = self.quasi_act(group(lambda_q_context) + share(lambda_q_query))
+        lambda_k = self.quasi_act(group(lambda_k_context) + share(lambda_k_key))
         lambda_q_scalar = 1.0
         lambda_k_scalar = 1.0
         lambda_context = lambda_q_scalar*lambda_q + lambda_k_scalar*lambda_k
         lambda_context = (1 - lambda_context)
-        quasi_attention_prob = lambda_context * quasi_attention_scores
-        new_attention_probs = attention_probs + quasi_attention_prob
-
-        ######################################################################
-
-        value_layer = self.transpose_for_scores(mixed_value_layer)
-
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        new_attention_probs = self.dropout(new_attention_probs)
 
-        context_layer = torch.matmul(new_attention_probs, value_layer)
+        def attend(start, end, query_layer, key_layer, value_layer,
+                   context_embedded_q, context_embedded_k, lambda_context):
+            # attention of the queries start:end; every score is per query
+            # row, so the blocks are independent
+            rows = lambda x: x[..., start:end, :]
+            ######################################################################
+            # Dot product attention
+            # Take the dot product between "query" and "key" to get the raw attention scores.
+            attention_scores = torch.matmul(rows(query_layer), key_layer.transpose(-1, -2))
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+            attention_scores = attention_scores + mask_rows(shared_attention_mask, start, end)
+            # Normalize the attention scores to probabilities.
+            attention_probs = nn.Softmax(dim=-1)(attention_scores) # [0, 1]
+
+            quasi_attention_scores = torch.matmul(rows(context_embedded_q), context_embedded_k.transpose(-1, -2))
+            quasi_attention_scores = quasi_attention_scores / math.sqrt(self.attention_head_size)
+            quasi_attention_scores = quasi_attention_scores + mask_rows(attention_mask, start, end)
+            quasi_scalar = 1.0
+            quasi_attention_scores = 1.0 * quasi_scalar * self.quasi_act(quasi_attention_scores) # [-1, 0]
+
+            quasi_attention_prob = rows(lambda_context) * group(quasi_attention_scores)
+            new_attention_probs = share(attention_probs) + quasi_attention_prob
+
+            ######################################################################
+
+            # This is actually dropping out entire tokens to attend to, which might
+            # seem a bit unusual, but is taken from the original Transformer paper.
+            new_attention_probs = self.dropout(new_attention_probs)
+
+            context_layer = ungroup(torch.matmul(new_attention_probs, share(value_layer)))
+            return context_layer, new_attention_probs, attention_probs, quasi_attention_prob
+
+        seq_len = query_layer.size(2)
+        chunk_size = self.attention_chunk_size
+        inputs = (query_layer, key_layer, value_layer,
+                  context_embedded_q, context_embedded_k, lambda_context)
+        if output_attentions or not chunk_size or seq_len <= chunk_size:
+            context_layer, new_attention_probs, attention_probs, quasi_attention_prob = \
+                attend(0, seq_len, *inputs)
+            if aspect_group_size is not None:
+                # attention_probs stays one row per sentence, the encoder only
+                # expands it when the attention maps are collected
+                new_attention_probs = ungroup(new_attention_probs)
+                quasi_attention_prob = ungroup(quasi_attention_prob)
+                lambda_context = ungroup(lambda_context)
+        else:
+            # Without the attention maps, the queries are attended to one
+            # block at a time, so no (seq_len, seq_len) map is ever built in
+            # full. With checkpoint_attention, in training the blocks are
+            # recomputed in the backward pass instead of keeping their maps.
+            # the heads are made contiguous once, not again for every block
+            inputs = tuple(x.contiguous() for x in inputs)
+            blocks = []
+            for start in range(0, seq_len, chunk_size):
+                end = min(start + chunk_size, seq_len)
+                if self.checkpoint_attention and torch.is_grad_enabled():
+                    block = checkpoint(lambda *args: attend(*args)[0],
+                                       start, end, *inputs, use_reentrant=False)
+                else:
+                    block = attend(start, end, *inputs)[0]
+                blocks.append(block)
+            context_layer = torch.cat(blocks, dim=2)
+            new_attention_probs = attention_probs = quasi_attention_prob = \
+                lambda_context = None
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
@@ -370,10 +492,15 @@ class ContextBERTAttention(nn.Module):
 
     def forward(self, input_tensor, attention_mask,
                 # optional parameters for saving context information
-                device=None, context_embedded=None):
+                device=None, context_embedded=None,
+                aspect_group_size=None, output_attentions=False):
         self_output, new_attention_probs, attention_probs, quasi_attention_prob, lambda_context = \
             self.self.forward(input_tensor, attention_mask,
-                              device, context_embedded)
+                              device, context_embedded,
+                              aspect_group_size=aspect_group_size,
+                              output_attentions=output_attentions)
+        if aspect_group_size is not None:
+            input_tensor = expand_aspect_groups(input_tensor, aspect_group_size)
         attention_output = self.output(self_output, input_tensor)
         return attention_output, new_attention_probs, attention_probs, quasi_attention_prob, lambda_context
 
@@ -386,10 +513,13 @@ class ContextBERTLayer(nn.Module):
 
     def forward(self, hidden_states, attention_mask,
                 # optional parameters for saving context information
-                device=None, context_embedded=None):
+                device=None, context_embedded=None,
+                aspect_group_size=None, output_attentions=False):
         attention_output, new_attention_probs, attention_probs, quasi_attention_prob, lambda_context = \
             self.attention(hidden_states, attention_mask,
-                           device, context_embedded)
+                           device, context_embedded,
+                           aspect_group_size=aspect_group_size,
+                           output_attentions=output_attentions)
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
         return layer_output, new_attention_probs, attention_probs, quasi_attention_prob, lambda_context
@@ -405,35 +535,104 @@ class ContextBERTEncoder(nn.Module):
 
         context_layer = ContextBERTLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(context_layer) for _ in range(config.num_hidden_layers)])    
+        self.checkpoint_every = config.checkpoint_every
+
+    def context_term(self, layer_index, context_embeddings):
+        """The part of the context transform that only depends on the context.
+
+        context_layer[i] is applied to [context; hidden_states] with the same
+        context at every position, so its context half, the bias and the
+        context residual reduce to one (batch_size, d_hidden) term per sequence.
+        """
+        weight, bias = linear_weight_and_bias(self.context_layer[layer_index])
+        hidden_size = context_embeddings.size(-1)
+        return F.linear(context_embeddings, weight[:, :hidden_size], bias) + \
+            context_embeddings
+
+    def deep_context(self, layer_index, hidden_states, context_term,
+                     aspect_group_size=None):
+        """context_layer[i]([context; hidden_states]) + context, broadcast over tokens."""
+        weight, _ = linear_weight_and_bias(self.context_layer[layer_index])
+        hidden_size = hidden_states.size(-1)
+        hidden_term = F.linear(hidden_states, weight[:, hidden_size:])
+        if aspect_group_size is not None:
+            # hidden_states hold one row per sentence, context_term one per aspect
+            deep_context_hidden = hidden_term.unsqueeze(1) + \
+                context_term.view(-1, aspect_group_size, 1, hidden_size)
+            return deep_context_hidden.view((-1,) + hidden_term.shape[1:])
+        return hidden_term + context_term.unsqueeze(1)
 
     def forward(self, hidden_states, attention_mask,
                 # optional parameters for saving context information
-                device=None, context_embeddings=None):
+                device=None, context_embeddings=None, context_terms=None,
+                aspect_group_size=None, output_attentions=False):
         #######################################################################
         # Here, we can try other ways to incoperate the context!
-        # Just make sure the output context_embedded is in the 
+        # Just make sure the output deep_context_hidden is in the 
         # shape of (batch_size, seq_len, d_hidden).
+        # context_embeddings are (batch_size, d_hidden) and only enter through
+        # the per-sequence context_term; context_terms, if given, are those
+        # terms precomputed for every layer.
+        # With aspect_group_size, the incoming hidden_states hold a single row
+        # per sentence and only the first layer runs on the shared rows.
+        # The per-layer attention maps are only kept around when
+        # output_attentions is set, otherwise None is returned for them.
         all_encoder_layers = []
-        all_new_attention_probs = []
-        all_attention_probs = []
-        all_quasi_attention_prob = []
-        all_lambda_context = []
-        layer_index = 0
-        for layer_module in self.layer:
-            # update context
-            deep_context_hidden = torch.cat([context_embeddings, hidden_states], dim=-1)
-            deep_context_hidden = self.context_layer[layer_index](deep_context_hidden)
-            deep_context_hidden += context_embeddings
-            # BERT encoding
-            hidden_states, new_attention_probs, attention_probs, quasi_attention_prob, lambda_context = \
-                    layer_module(hidden_states, attention_mask,
-                                 device, deep_context_hidden)
-            all_encoder_layers.append(hidden_states)
-            all_new_attention_probs.append(new_attention_probs.clone())
-            all_attention_probs.append(attention_probs.clone())
-            all_quasi_attention_prob.append(quasi_attention_prob.clone())
-            all_lambda_context.append(lambda_context.clone())
-            layer_index += 1
+        all_new_attention_probs = None
+        all_attention_probs = None
+        all_quasi_attention_prob = None
+        all_lambda_context = None
+        if output_attentions:
+            all_new_attention_probs = []
+            all_attention_probs = []
+            all_quasi_attention_prob = []
+            all_lambda_context = []
+        # With checkpoint_every set, training runs the layers in segments of
+        # that many layers, keeping only the input of each segment for the
+        # backward pass and recomputing the rest.
+        def run_layers(start, end, hidden_states):
+            layer_outputs = []
+            for layer_index in range(start, end):
+                layer_module = self.layer[layer_index]
+                group_size = aspect_group_size if layer_index == 0 else None
+                # update context
+                if context_terms is None:
+                    context_term = self.context_term(layer_index, context_embeddings)
+                else:
+                    context_term = context_terms[layer_index]
+                deep_context_hidden = self.deep_context(layer_index, hidden_states,
+                                                        context_term, group_size)
+                # BERT encoding
+                hidden_states, new_attention_probs, attention_probs, quasi_attention_prob, lambda_context = \
+                        layer_module(hidden_states, attention_mask,
+                                     device, deep_context_hidden,
+                                     aspect_group_size=group_size,
+                                     output_attentions=output_attentions)
+                if output_attentions and group_size is not None:
+                    attention_probs = expand_aspect_groups(attention_probs, group_size)
+                layer_outputs.append((hidden_states, new_attention_probs, attention_probs,
+                                      quasi_attention_prob, lambda_context))
+            return layer_outputs
+
+        num_layers = len(self.layer)
+        use_checkpoint = self.checkpoint_every > 0 and self.training and \
+            torch.is_grad_enabled()
+        segment_size = self.checkpoint_every if use_checkpoint else num_layers
+        for start in range(0, num_layers, segment_size):
+            end = min(start + segment_size, num_layers)
+            if use_checkpoint:
+                layer_outputs = checkpoint(run_layers, start, end, hidden_states,
+                                           use_reentrant=False)
+            else:
+                layer_outputs = run_layers(start, end, hidden_states)
+            for hidden_states, new_attention_probs, attention_probs, quasi_attention_prob, lambda_context \
+                    in layer_outputs:
+                all_encoder_layers.append(hidden_states)
+                if output_attentions:
+                    all_new_attention_probs.append(new_attention_probs)
+                    all_attention_probs.append(attention_probs)
+                    all_quasi_attention_prob.append(quasi_attention_prob)
+                    all_lambda_context.append(lambda_context)
         #######################################################################
         return all_encoder_layers, all_new_attention_probs, all_attention_probs, all_quasi_attention_prob, all_lambda_context
 
@@ -452,10 +651,55 @@ class ContextBertModel(nn.Module):
         self.pooler = ContextBERTPooler(config)
 
         self.context_embeddings = nn.Embedding(16, config.hidden_size)
+        self._context_table = None
+        self._context_table_key = None
+
+    def train(self, mode=True):
+        # the optimizer updates weights through .data, which does not bump
+        # their version counters, so drop the cached table on every switch
+        self._context_table = None
+        return super(ContextBertModel, self).train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # quantized context layers keep their weights outside of parameters(),
+        # where the table key cannot see them being replaced
+        self._context_table = None
+        super(ContextBertModel, self)._load_from_state_dict(*args, **kwargs)
+
+    def context_table(self):
+        """Context terms of every context id for every layer, shaped
+        (num_hidden_layers, num_contexts, hidden_size).
+
+        Only used at inference, where they are fixed; the table is rebuilt
+        whenever the context weights are moved or modified.
+        """
+        params = [self.context_embeddings.weight] + \
+            list(self.encoder.context_layer.parameters())
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        if self._context_table is None or self._context_table_key != key:
+            with torch.no_grad():
+                context_embeddings = self.context_embeddings.weight
+                self._context_table = torch.stack(
+                    [self.encoder.context_term(layer_index, context_embeddings)
+                     for layer_index in range(len(self.encoder.layer))])
+            self._context_table_key = key
+        return self._context_table
 
     def forward(self, input_ids, token_type_ids=None, attention_mask=None,
                 # optional parameters for saving context information
-                device=None, context_ids=None):
+                device=None, context_ids=None,
+                aspect_group_size=None, output_attentions=False):
+        """
+        aspect_group_size: when set, every consecutive `aspect_group_size`
+            rows are aspect variants of one sentence with identical
+            input_ids, token_type_ids and attention_mask (the
+            --context_standalone layout). The embeddings and the
+            aspect-independent parts of the first layer are then computed
+            once per sentence and broadcast over its aspects.
+        output_attentions: whether to return the per-layer attention maps.
+            They are only needed for analysis (e.g. the visualization
+            notebook) and are returned as None otherwise.
+        """
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -476,19 +720,34 @@ class ContextBertModel(nn.Module):
         extended_attention_mask = extended_attention_mask.float()
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        if aspect_group_size is not None:
+            if input_ids.size(0) % aspect_group_size != 0:
+                raise ValueError(
+                    "The batch size (%d) is not a multiple of the aspect group "
+                    "size (%d)" % (input_ids.size(0), aspect_group_size))
+            embedding_output = self.embeddings(input_ids[::aspect_group_size],
+                                               token_type_ids[::aspect_group_size])
+        else:
+            embedding_output = self.embeddings(input_ids, token_type_ids)
 
         #######################################################################
         # Context embeddings
-        seq_len = embedding_output.shape[1]
         context_embedded = self.context_embeddings(context_ids).squeeze(dim=1)
-        context_embedding_output = torch.stack(seq_len*[context_embedded], dim=1)
+        context_terms = None
+        # the table is a cache torch.compile cannot guard on, compiled
+        # graphs compute the context terms inline instead
+        if not self.training and not torch.is_grad_enabled() and \
+                not torch.compiler.is_compiling():
+            context_terms = self.context_table()[:, context_ids.squeeze(dim=1)]
         #######################################################################
 
         all_encoder_layers, all_new_attention_probs, all_attention_probs, all_quasi_attention_prob, all_lambda_context = \
             self.encoder(embedding_output, extended_attention_mask,
                          device,
-                         context_embedding_output)
+                         context_embedded,
+                         context_terms=context_terms,
+                         aspect_group_size=aspect_group_size,
+                         output_attentions=output_attentions)
         sequence_output = all_encoder_layers[-1]
         pooled_output = self.pooler(sequence_output, attention_mask)
         return pooled_output, all_new_attention_probs, all_attention_probs, all_quasi_attention_prob, all_lambda_context
@@ -535,10 +794,7 @@ class QACGBertForSequenceClassification(nn.Module):
         # We turn the bias off to accomedate this as well.
         init_perturbation = 1e-2
         for layer_module in self.bert.encoder.layer:
-            layer_module.attention.self.lambda_q_context_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_k_context_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_q_query_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_k_key_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
+            layer_module.attention.self.lambda_gates.weight.data.normal_(mean=0.0, std=init_perturbation)
 
         #######################################################################
         if init_lrp:
@@ -548,16 +804,20 @@ class QACGBertForSequenceClassification(nn.Module):
     def forward(self, input_ids, token_type_ids, attention_mask, seq_lens,
                 device=None, labels=None,
                 # optional parameters for saving context information
-                context_ids=None):
+                context_ids=None,
+                aspect_group_size=None, output_attentions=False):
 
         pooled_output, all_new_attention_probs, all_attention_probs, all_quasi_attention_prob, all_lambda_context = \
             self.bert(input_ids, token_type_ids, attention_mask,
-                      device, context_ids)
+                      device, context_ids,
+                      aspect_group_size=aspect_group_size,
+                      output_attentions=output_attentions)
         
         pooled_output = self.dropout(pooled_output)
 
+        # outputs stay fp32 under bf16 autocast
         logits = \
-            self.classifier(pooled_output)
+            self.classifier(pooled_output).float()
         if labels is not None:
             loss_fct = CrossEntropyLoss()
             loss = loss_fct(logits, labels)
@@ -601,10 +861,7 @@ class QACGBertForSequenceScore(nn.Module):
 
         init_perturbation = 1e-2
         for layer_module in self.bert.encoder.layer:
-            layer_module.attention.self.lambda_q_context_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_k_context_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_q_query_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_k_key_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
+            layer_module.attention.self.lambda_gates.weight.data.normal_(mean=0.0, std=init_perturbation)
 
         if init_lrp:
             print("init_lrp = True")
@@ -612,16 +869,20 @@ class QACGBertForSequenceScore(nn.Module):
 
     def forward(self, input_ids, token_type_ids, attention_mask, seq_lens,
                 device=None, labels=None,
-                context_ids=None):
+                context_ids=None,
+                aspect_group_size=None, output_attentions=False):
 
         pooled_output, all_new_attention_probs, all_attention_probs, all_quasi_attention_prob, all_lambda_context = \
             self.bert(input_ids, token_type_ids, attention_mask,
-                      device, context_ids)
+                      device, context_ids,
+                      aspect_group_size=aspect_group_size,
+                      output_attentions=output_attentions)
 
         pooled_output = self.dropout(pooled_output)
 
-        tmp_score = self.scorer(pooled_output)
-        score = torch.where(tmp_score > 1, torch.full([len(tmp_score), 1], 1.5, device=tmp_score.device), tmp_score)
+        # outputs stay fp32 under bf16 autocast
+        tmp_score = self.scorer(pooled_output).float()
+        score = torch.where(tmp_score > 1, torch.full_like(tmp_score, 1.5), tmp_score)
         if labels is not None:
             loss_fct = MSELoss()
             loss = loss_fct(score, labels)
@@ -665,10 +926,7 @@ class QACGBertForSequenceScoreClassification(nn.Module):
 
         init_perturbation = 1e-2
         for layer_module in self.bert.encoder.layer:
-            layer_module.attention.self.lambda_q_context_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_k_context_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_q_query_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
-            layer_module.attention.self.lambda_k_key_layer.weight.data.normal_(mean=0.0, std=init_perturbation)
+            layer_module.attention.self.lambda_gates.weight.data.normal_(mean=0.0, std=init_perturbation)
 
         if init_lrp:
             print("init_lrp = True")
@@ -676,15 +934,19 @@ class QACGBertForSequenceScoreClassification(nn.Module):
 
     def forward(self, input_ids, token_type_ids, attention_mask, seq_lens,
                 device=None, labels=None,
-                context_ids=None):
+                context_ids=None,
+                aspect_group_size=None, output_attentions=False):
 
         pooled_output, all_new_attention_probs, all_attention_probs, all_quasi_attention_prob, all_lambda_context = \
             self.bert(input_ids, token_type_ids, attention_mask,
-                      device, context_ids)
+                      device, context_ids,
+                      aspect_group_size=aspect_group_size,
+                      output_attentions=output_attentions)
 
         pooled_output = self.dropout(pooled_output)
 
-        score = self.scorer(pooled_output)
+        # outputs stay fp32 under bf16 autocast
+        score = self.scorer(pooled_output).float()
         if labels is not None:
             loss_fct = MSELoss()
             loss = loss_fct(score, labels)
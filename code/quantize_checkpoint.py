@@ -0,0 +1,187 @@
+# coding=utf-8
+
+"""Quantize a fine-tuned checkpoint to int8 weights.
+
+Every Linear layer of the model (including the context and lambda gate
+layers) is replaced by a dynamically quantized one, and the resulting
+state dict is written next to the input checkpoint. Load it with
+`--quantized` in aspect_detector.py or scorer.py.
+
+Given a labelled FiQA test file, the fp32 and int8 models are both
+evaluated on it on CPU, to report the accuracy change and the speedup.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+import aspect_detector
+import scorer
+from util.data import batch_to_device
+from util.features import convert_examples_to_features
+from util.precision import quantize
+
+parser = argparse.ArgumentParser()
+
+## Required parameters
+parser.add_argument("--model",
+                    default = "aspect_detector",
+                    choices = ["aspect_detector", "scorer"],
+                    help = "Which inference model the checkpoint belongs to.")
+parser.add_argument("--vocab_file",
+                    default = None,
+                    type = str,
+                    required = True,
+                    help = "The vocabulary file that the BERT model was trained on.")
+parser.add_argument("--bert_config_file",
+                    default = None,
+                    type = str,
+                    required = True,
+                    help = "The config json file corresponding to the pre-trained BERT model. \n"
+                        "This specifies the model architecture.")
+parser.add_argument("--init_checkpoint",
+                    default = None,
+                    type = str,
+                    required = True,
+                    help = "The fine-tuned checkpoint, e.g. best_checkpoint.bin.")
+
+## Other parameters
+parser.add_argument("--output_path",
+                    default = None,
+                    type = str,
+                    help = "Where to write the int8 checkpoint; defaults to "
+                        "<init_checkpoint>_int8.bin.")
+parser.add_argument("--test_path",
+                    default = None,
+                    type = str,
+                    help = "Labelled test file to compare the models on: acd_2_headline_crr_test.csv "
+                        "for the aspect detector, fiqa_score_crr_2_test.csv for the scorer.")
+parser.add_argument("--max_seq_length",
+                    default = 128,
+                    type = int)
+parser.add_argument("--eval_batch_size",
+                    default = 32,
+                    type = int)
+parser.add_argument("--context_standalone",
+                    default = False,
+                    action = 'store_true')
+
+args = parser.parse_args()
+
+
+def load_model():
+    if args.model == "aspect_detector":
+        return aspect_detector.get_model_and_tokenizer(
+            vocab_file=args.vocab_file, bert_config_file=args.bert_config_file,
+            init_checkpoint=args.init_checkpoint,
+            label_list=aspect_detector.label_list)
+    return scorer.get_model_and_tokenizer(
+        vocab_file=args.vocab_file, bert_config_file=args.bert_config_file,
+        init_checkpoint=args.init_checkpoint)
+
+
+def evaluate_aspect_detector(model, tokenizer, test_data):
+    """Accuracy and F1 of the "Yes" decisions over all (sentence, aspect) pairs."""
+    n_aspects = len(aspect_detector.context_id_map_fiqa)
+    # id, sentence id, label, aspect, sentence; one row per aspect, in the
+    # order of context_id_map_fiqa
+    sentences = test_data.iloc[::n_aspects, 4].tolist()
+    labels = (test_data[2].values == 'Yes').reshape(-1, n_aspects)
+    detector = aspect_detector.AspectDetector(
+        model, tokenizer, torch.device("cpu"),
+        max_seq_length=args.max_seq_length,
+        context_standalone=args.context_standalone,
+        batch_size=args.eval_batch_size)
+    start = time.perf_counter()
+    predictions = detector.predict(sentences).astype(bool)
+    elapsed = time.perf_counter() - start
+
+    accuracy = (predictions == labels).mean()
+    tp = (predictions & labels).sum()
+    f1 = 2 * tp / max(1, predictions.sum() + labels.sum())
+    return {"accuracy": accuracy, "f1": f1}, predictions, elapsed
+
+
+def evaluate_scorer(model, tokenizer, test_data):
+    """Mean squared error of the sentiment scores."""
+    # score, aspect, sentence
+    examples = [scorer.InputExample(guid="test-%d" % i, text_a=str(line[2]),
+                                    text_b=str(line[1]), label=float(line[0]))
+                for i, line in enumerate(test_data.values)]
+    # the score data sets use the 16 FiQA aspects as contexts
+    features = convert_examples_to_features(
+        examples, args.max_seq_length, tokenizer, 1, args.context_standalone,
+        aspect_detector.context_id_map_fiqa)
+    input_ids, input_mask, segment_ids, scores, seq_lens, context_ids = \
+        [torch.from_numpy(a) for a in features]
+
+    model.eval()
+    predictions = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for batch_start in range(0, len(examples), args.eval_batch_size):
+            batch_end = batch_start + args.eval_batch_size
+            max_seq_lens = int(seq_lens[batch_start:batch_end].max())
+            batch = batch_to_device(
+                [input_ids[batch_start:batch_end, :max_seq_lens],
+                 input_mask[batch_start:batch_end, :max_seq_lens],
+                 segment_ids[batch_start:batch_end, :max_seq_lens],
+                 seq_lens[batch_start:batch_end],
+                 context_ids[batch_start:batch_end]], torch.device("cpu"))
+            score = model(batch[0], batch[2], batch[1], batch[3],
+                          device=torch.device("cpu"), context_ids=batch[4])
+            predictions.append(score.numpy()[:, 0])
+    elapsed = time.perf_counter() - start
+
+    predictions = np.concatenate(predictions)
+    mse = np.mean((predictions - scores.numpy()) ** 2)
+    return {"mse": mse}, predictions, elapsed
+
+
+def convert():
+    output_path = args.output_path
+    if output_path is None:
+        output_path = os.path.splitext(args.init_checkpoint)[0] + "_int8.bin"
+
+    model, tokenizer = load_model()
+    model.eval()
+    quantized_model = quantize(model)
+    print("Saving the int8 model to {}".format(output_path))
+    torch.save(quantized_model.state_dict(), output_path)
+
+    fp32_size = os.path.getsize(args.init_checkpoint) / 2 ** 20
+    int8_size = os.path.getsize(output_path) / 2 ** 20
+    print("checkpoint size: fp32 {:.1f} MB, int8 {:.1f} MB ({:.2f}x smaller)".format(
+        fp32_size, int8_size, fp32_size / int8_size))
+
+    if args.test_path is None:
+        return
+
+    test_data = pd.read_csv(args.test_path, header=None)
+    evaluate = evaluate_aspect_detector if args.model == "aspect_detector" \
+        else evaluate_scorer
+    fp32_metrics, fp32_predictions, fp32_time = evaluate(model, tokenizer, test_data)
+    int8_metrics, int8_predictions, int8_time = evaluate(quantized_model, tokenizer, test_data)
+
+    for name in fp32_metrics:
+        print("{}: fp32 {:.4f}, int8 {:.4f}, delta {:+.4f}".format(
+            name, fp32_metrics[name], int8_metrics[name],
+            int8_metrics[name] - fp32_metrics[name]))
+    if args.model == "aspect_detector":
+        print("int8 decisions agreeing with fp32: {:.4f}".format(
+            (fp32_predictions == int8_predictions).mean()))
+    else:
+        print("max score difference to fp32: {:.4f}".format(
+            np.abs(fp32_predictions - int8_predictions).max()))
+    print("test set latency: fp32 {:.2f} s, int8 {:.2f} s ({:.2f}x faster)".format(
+        fp32_time, int8_time, fp32_time / int8_time))
+
+
+if __name__ == "__main__":
+    convert()
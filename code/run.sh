@@ -14,7 +14,8 @@ CUDA_VISIBLE_DEVICES=1,4,5,8 python run_classifier.py \
 --bert_config_file ../models/BERT-Google/bert_config.json \
 --init_checkpoint ../models/BERT-Google/pytorch_model.bin \
 --seed 123 \
---evaluate_interval 25
+--evaluate_interval 25 \
+--feature_cache_dir ../results/feature_cache/
 
 # other models we tried
 CUDA_VISIBLE_DEVICES=1,4,5,8 python run_classifier.py \
@@ -33,4 +34,5 @@ CUDA_VISIBLE_DEVICES=1,4,5,8 python run_classifier.py \
 --init_checkpoint ../models/BERT-Google/pytorch_model.bin \
 --seed 123 \
 --evaluate_interval 25 \
+--feature_cache_dir ../results/feature_cache/ \
 --context_standalone
\ No newline at end of file
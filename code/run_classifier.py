@@ -1,6 +1,7 @@
 import argparse
 
 from util.train_helper import *
+from util.checkpoint import CheckpointWriter
 
 def run(args):
 
@@ -21,14 +22,22 @@ def run(args):
     global_best_acc = -1
     epoch=0
     evaluate_interval = args.evaluate_interval
+    checkpoint_writer = CheckpointWriter(args.output_dir,
+                                         keep_last=args.keep_last_checkpoints,
+                                         keep_best=args.keep_best_checkpoints,
+                                         checkpoint_format=args.checkpoint_format,
+                                         base_checkpoint=args.init_checkpoint,
+                                         best_metric=global_best_acc)
     # training epoch to eval
     for _ in trange(int(args.num_train_epochs), desc="Epoch"):
         # train a teacher model solving this task
         global_step, global_best_acc = \
             step_train(train_dataloader, test_dataloader, model, optimizer, 
                         device, n_gpu, evaluate_interval, global_step, 
-                        output_log_file, epoch, global_best_acc, args)
+                        output_log_file, epoch, global_best_acc, args,
+                        checkpoint_writer)
         epoch += 1
+    checkpoint_writer.close()
 
     logger.info("***** Global best performance *****")
     logger.info("accuracy on dev set: " + str(global_best_acc))
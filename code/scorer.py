@@ -2,6 +2,10 @@ import pandas as pd
 from tqdm import tqdm
 from model.QACGBERT import *
 from util.tokenization import *
+from util.checkpoint import build_from_checkpoint
+from util.data import batch_to_device
+from util.features import convert_examples_to_features
+from util.precision import autocast, quantize
 from torch.utils.data import DataLoader, TensorDataset
 import random
 import warnings
@@ -22,16 +26,6 @@ class InputExample(object):
         self.label = label
 
 
-class InputFeatures(object):
-    def __init__(self, input_ids, input_mask, segment_ids, score, seq_len, context_ids):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.score = score
-        self.seq_len = seq_len
-        self.context_ids = context_ids
-
-
 def convert_to_unicode(text):
     if six.PY3:
         if isinstance(text, str):
@@ -59,96 +53,11 @@ def get_test_examples(path):
     return _create_examples(test_data, "test")
 
 
-def truncate_seq_pair(tokens_a, tokens_b, max_length):
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
-def convert_examples_to_features(examples, max_seq_length,
-                                 tokenizer, max_context_length,
-                                 context_standalone, args):
-    features = []
-    for (ex_index, example) in enumerate(tqdm(examples)):
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-        tokens_context = None
-        if example.text_b:
-            tokens_context = tokenizer.tokenize(example.text_b)
-
-        if tokens_b and not context_standalone:
-            truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-        else:
-            if len(tokens_a) > max_seq_length - 2:
-                tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-        tokens = []
-        segment_ids = []
-        tokens.append("[CLS]")
-        segment_ids.append(0)
-        for token in tokens_a:
-            tokens.append(token)
-            segment_ids.append(0)
-        tokens.append("[SEP]")
-        segment_ids.append(0)
-
-        if tokens_b and not context_standalone:
-            for token in tokens_b:
-                tokens.append(token)
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        context_ids = []
-        if tokens_context:
-            context_ids = [context_id_map_fiqa[example.text_b]]
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        seq_len = len(input_ids)
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        while len(context_ids) < max_context_length:
-            context_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(context_ids) == max_context_length
-
-        features.append(
-            InputFeatures(
-                input_ids=input_ids,
-                input_mask=input_mask,
-                segment_ids=segment_ids,
-                score=example.label,
-                seq_len=seq_len,
-                context_ids=context_ids))
-
-    return features
-
-
 def get_model_and_tokenizer(vocab_file,
                                bert_config_file=None, init_checkpoint=None,
                                do_lower_case=True,
-                               init_lrp=False):
-    tokenizer = FullTokenizer(
+                               init_lrp=False, quantized=False):
+    tokenizer = FastFullTokenizer(
         vocab_file=vocab_file, do_lower_case=do_lower_case, pretrain=False)
     if bert_config_file is not None:
         bert_config = BertConfig.from_json_file(bert_config_file)
@@ -166,24 +75,23 @@ def get_model_and_tokenizer(vocab_file,
             initializer_range=0.02
         )
     bert_config.vocab_size = len(tokenizer.vocab)
-    model = QACGBertForSequenceScore(
-                bert_config,
-                init_weight=True,
-                init_lrp=init_lrp)
-
-    if init_checkpoint is not None:
-        if "checkpoint" in init_checkpoint:
-            state_dict = torch.load(init_checkpoint, map_location='cpu')
-            from collections import OrderedDict
-            new_state_dict = OrderedDict()
-            for k, v in state_dict.items():
-                if k.startswith('module.'):
-                    name = k[7:]
-                    new_state_dict[name] = v
-                else:
-                    new_state_dict[k] = v
-            model.load_state_dict(new_state_dict)
-        else:
+
+    def build():
+        model = QACGBertForSequenceScore(
+                    bert_config,
+                    init_weight=True,
+                    init_lrp=init_lrp)
+        if quantized:
+            # checkpoints written by quantize_checkpoint.py
+            model = quantize(model)
+        return model
+
+    if init_checkpoint is not None and (quantized or "checkpoint" in init_checkpoint):
+        # quantized layers cannot be built on the meta device
+        model = build_from_checkpoint(build, init_checkpoint, skip_init=not quantized)
+    else:
+        model = build()
+        if init_checkpoint is not None:
             model.bert.load_state_dict(torch.load(init_checkpoint, map_location='cpu'), strict=False)
     return model, tokenizer
 
@@ -218,20 +126,17 @@ def data_and_model_loader(device, n_gpu, args):
     model, tokenizer = get_model_and_tokenizer(vocab_file=args.vocab_file,
                                 bert_config_file=args.bert_config_file, init_checkpoint=args.init_checkpoint,
                                 do_lower_case=True,
-                                init_lrp=False)
+                                init_lrp=False, quantized=args.quantized)
 
     test_examples = get_test_examples(args.path)
     test_features = convert_examples_to_features(
         test_examples, args.max_seq_length,
         tokenizer, args.max_context_length,
-        args.context_standalone, args)
+        args.context_standalone, context_id_map_fiqa,
+        num_workers=args.num_workers)
 
-    all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-    all_score = torch.tensor([f.score for f in test_features], dtype=torch.float)
-    all_seq_len = torch.tensor([[f.seq_len] for f in test_features], dtype=torch.long)
-    all_context_ids = torch.tensor([f.context_ids for f in test_features], dtype=torch.long)
+    all_input_ids, all_input_mask, all_segment_ids, all_score, \
+        all_seq_len, all_context_ids = [torch.from_numpy(a) for a in test_features]
 
     test_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
                               all_score, all_seq_len, all_context_ids)
@@ -263,16 +168,14 @@ def pred(args):
         input_mask = input_mask[:, :max_seq_lens]
         segment_ids = segment_ids[:, :max_seq_lens]
 
-        input_ids = input_ids.to(device)
-        input_mask = input_mask.to(device)
-        segment_ids = segment_ids.to(device)
-        score = score.to(device)
-        seq_lens = seq_lens.to(device)
-        context_ids = context_ids.to(device)
+        input_ids, input_mask, segment_ids, score, seq_lens, context_ids = \
+            batch_to_device((input_ids, input_mask, segment_ids, score, seq_lens,
+                             context_ids), device)
 
-        _, pred_score, _, _, _, _ = \
-            model(input_ids, segment_ids, input_mask, seq_lens, device=device, labels=score,
-                  context_ids=context_ids)
+        with autocast(device, args.precision):
+            _, pred_score, _, _, _, _ = \
+                model(input_ids, segment_ids, input_mask, seq_lens, device=device, labels=score,
+                      context_ids=context_ids)
         y_pred.append(pred_score.detach().numpy()[0][0])
 
     return y_pred
@@ -290,6 +193,10 @@ if __name__ == '__main__':
     parser.add_argument("--no_cuda", default=False, action='store_true')
     parser.add_argument("--max_context_length", default=1, type=int)
     parser.add_argument("--context_standalone", default=False, action='store_true')
+    parser.add_argument("--num_workers", default=1, type=int)
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16"])
+    parser.add_argument("--quantized", default=False, action='store_true',
+                        help="init_checkpoint holds int8 weights from quantize_checkpoint.py")
     parser.add_argument('--seed', type=int, default=123)
     args = parser.parse_args()
 
@@ -47,6 +47,20 @@ parser.add_argument("--init_checkpoint",
                     default=None,
                     type=str,
                     help="Initial checkpoint (usually from a pre-trained model).")
+parser.add_argument("--keep_last_checkpoints",
+                    default=3,
+                    type=int,
+                    help="Number of the latest checkpoint_<step>.bin files kept in output_dir, -1 keeps all of them.")
+parser.add_argument("--keep_best_checkpoints",
+                    default=1,
+                    type=int,
+                    help="Number of the best checkpoint_<step>.bin files by the task metric kept besides the latest, \n"
+                            "-1 keeps all of them. best_checkpoint.bin is always kept.")
+parser.add_argument("--checkpoint_format",
+                    default="fp32",
+                    choices=["fp32", "bf16", "fp16", "delta"],
+                    help="How the checkpoints are stored. bf16 and fp16 halve them, delta stores the BERT weights \n"
+                            "as int8 differences to init_checkpoint, which has to be the BERT pretrain.")
 parser.add_argument("--save_checkpoint_path",
                     default=None,
                     type=str,
@@ -67,10 +81,28 @@ parser.add_argument("--max_context_length",
                     help="The maximum total input sequence length after WordPiece tokenization. \n"
                             "Sequences longer than this will be truncated, and sequences shorter \n"
                             "than this will be padded.")
+parser.add_argument("--num_workers",
+                    default=1,
+                    type=int,
+                    help="Number of processes used to convert the examples into features.")
+parser.add_argument("--feature_cache_dir",
+                    default=None,
+                    type=str,
+                    help="The directory to cache the converted features in, they are not cached by default.")
 parser.add_argument("--train_batch_size",
                     default=20,
                     type=int,
                     help="Total batch size for training.")
+parser.add_argument("--bucket_size",
+                    default=0,
+                    type=int,
+                    help="Number of training batches pooled and sorted by length, so that each batch holds \n"
+                            "sequences of similar length. 0 disables the bucketing.")
+parser.add_argument("--prefetch_depth",
+                    default=2,
+                    type=int,
+                    help="Number of batches prepared and moved to the device ahead in a background thread. \n"
+                            "0 prepares them inline.")
 parser.add_argument("--eval_batch_size",
                     default=20,
                     type=int,
@@ -108,6 +140,31 @@ parser.add_argument('--seed',
                     type=int, 
                     default=42,
                     help="random seed for initialization")
+parser.add_argument("--precision",
+                    default="fp32",
+                    choices=["fp32", "bf16"],
+                    help="Precision of the forward passes. bf16 runs the matrix products in bfloat16 under autocast.")
+parser.add_argument("--checkpoint_every",
+                    default=0,
+                    type=int,
+                    help="Recompute the activations of every this many encoder layers in the backward pass \n"
+                            "instead of keeping them, trading compute for memory. 0 keeps all of them.")
+parser.add_argument("--checkpoint_attention",
+                    default=False,
+                    action='store_true',
+                    help="Recompute the blocks of the chunked quasi-attention (QACGBERT) in the backward pass \n"
+                            "instead of keeping their attention maps, trading compute for memory.")
+parser.add_argument("--per_param_clip",
+                    default=False,
+                    action='store_true',
+                    help="Clip the gradient of every parameter to norm 1 on its own, as earlier versions did. \n"
+                            "By default the norm of all the gradients together is clipped to 1, which changes \n"
+                            "training results; pass this to reproduce runs made before the change.")
+parser.add_argument("--optimizer_state",
+                    default="fp32",
+                    choices=["fp32", "bf16", "int8"],
+                    help="How the Adam moments are stored between steps. bf16 halves their memory and int8 \n"
+                            "(block-quantized) quarters it; the updates are still computed in fp32.")
 parser.add_argument('--gradient_accumulation_steps',
                     type=int,
                     default=1,
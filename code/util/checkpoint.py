@@ -0,0 +1,372 @@
+# coding=utf-8
+
+"""Background writing of the training checkpoints, and their compact
+formats."""
+
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from torch.nn.modules.utils import consume_prefix_in_state_dict_if_present
+from torch.overrides import TorchFunctionMode
+
+from model.QACGBERT import pack_legacy_state_dict, packed_attention_params
+
+logger = logging.getLogger(__name__)
+
+checkpoint_formats = ["fp32", "bf16", "fp16", "delta"]
+# deltas sharing one int8 scale
+_DELTA_BLOCK_SIZE = 256
+
+
+def _base_key(key):
+    """The key of `key` in a BERT pretrain checkpoint, which holds the
+    weights of `model.bert`."""
+    if key.startswith('module.'):
+        key = key[7:]
+    if key.startswith('bert.'):
+        return key[5:]
+    return None
+
+
+def _load_base(path):
+    """The BERT pretrain weights at `path`, with the query, key and value
+    layers (and the other separately stored attention layers) stacked into
+    the packed layers the models hold."""
+    state_dict = OrderedDict(_load(path))
+    prefixes = set()
+    for parts in packed_attention_params.values():
+        suffix = "." + parts[0] + ".weight"
+        prefixes.update(k[:len(k) - len(suffix) + 1] for k in state_dict if k.endswith(suffix))
+    for prefix in prefixes:
+        pack_legacy_state_dict(state_dict, prefix, packed_attention_params)
+    return state_dict
+
+
+def _unpacked_in(key, base_state_dict):
+    """Whether `base_state_dict` holds the parts of the packed weight `key`
+    as separate layers."""
+    base_key = _base_key(key)
+    for packed, parts in packed_attention_params.items():
+        for param in ["weight", "bias"]:
+            suffix = "." + packed + "." + param
+            if base_key is not None and base_key.endswith(suffix):
+                prefix = base_key[:len(base_key) - len(suffix) + 1]
+                return all(prefix + part + "." + param in base_state_dict for part in parts)
+    return False
+
+
+def _checksum(tensors):
+    return sum(float(t.sum(dtype=torch.float64)) for t in tensors)
+
+
+def _encode_delta(delta):
+    """Rounds `delta` to int8 steps of the absolute maximum of each block over
+    127."""
+    flat = delta.reshape(-1).float()
+    padding = -flat.numel() % _DELTA_BLOCK_SIZE
+    blocks = torch.cat([flat, flat.new_zeros(padding)]).view(-1, _DELTA_BLOCK_SIZE)
+    scale = blocks.abs().amax(dim=1, keepdim=True) / 127
+    q = torch.round(blocks / scale.clamp(min=torch.finfo(torch.float32).tiny)).to(torch.int8)
+    # fine-tuning changes use the int8 steps about evenly, so a general
+    # purpose compressor gains little on top (~6% with zlib)
+    return {"delta": q.view(-1), "scale": scale.view(-1)}
+
+
+def _decode_delta(entry, base):
+    delta = (entry["delta"].float().view(-1, _DELTA_BLOCK_SIZE) * entry["scale"].unsqueeze(1)).view(-1)
+    return base + delta[:base.numel()].view_as(base).to(base.dtype)
+
+
+def compact_state_dict(state_dict, checkpoint_format, base_checkpoint=None,
+                       base_state_dict=None):
+    """`state_dict` in one of `checkpoint_formats`, to be read back with
+    `load_checkpoint`.
+
+    fp32 is the state dict itself. bf16 and fp16 round every floating point
+    tensor to that type. delta stores the weights of `model.bert` as their
+    difference to `base_state_dict`, the BERT pretrain weights loaded from
+    `base_checkpoint`, rounded to int8 steps of 1/127 of the largest change
+    in each block of 256. Separately stored query, key and value layers of
+    the base are stacked to match the packed layers first. The weights the
+    pretrain does not have (the context layers and the classifier) are kept
+    as they are. The changes of fine-tuning are small, so the weights
+    covered take a quarter of their size and are closer to the fine-tuned
+    ones than bf16; a QACGBERT checkpoint comes to about a third of fp32.
+    """
+    if checkpoint_format == "fp32":
+        return state_dict
+    if checkpoint_format in ["bf16", "fp16"]:
+        dtype = torch.bfloat16 if checkpoint_format == "bf16" else torch.float16
+        tensors = OrderedDict(
+            (k, v.to(dtype) if v.is_floating_point() else v) for k, v in state_dict.items())
+        return {"checkpoint_format": checkpoint_format, "tensors": tensors}
+    if checkpoint_format != "delta":
+        raise ValueError("Unknown checkpoint format: {}".format(checkpoint_format))
+
+    tensors = OrderedDict()
+    used = []
+    for k, v in state_dict.items():
+        base = base_state_dict.get(_base_key(k))
+        if base is None or base.shape != v.shape or not v.is_floating_point():
+            if v.is_floating_point() and _unpacked_in(k, base_state_dict):
+                raise ValueError("{} would be stored in full, the base weights hold "
+                                 "its parts unpacked".format(k))
+            tensors[k] = v
+            continue
+        tensors[k] = _encode_delta(v - base)
+        used.append(base)
+    # to tell a different base checkpoint at the same path on loading
+    return {"checkpoint_format": "delta", "tensors": tensors,
+            "base_checkpoint": base_checkpoint, "base_checksum": _checksum(used)}
+
+
+def _load(path):
+    """torch.load of `path` to CPU, memory-mapped: the tensors are read from
+    the file when they are first used, and are never copied into memory
+    that the load allocates."""
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # files written by torch < 1.6 cannot be mapped
+        return torch.load(path, map_location='cpu')
+
+
+def load_checkpoint(path, base_checkpoint=None):
+    """The fp32 state dict of a checkpoint in any of `checkpoint_formats`.
+
+    Delta checkpoints are added to the BERT pretrain checkpoint they were
+    written against, which is read from the path stored in them unless
+    `base_checkpoint` is given.
+    """
+    checkpoint = _load(path)
+    checkpoint_format = checkpoint.get("checkpoint_format")
+    if checkpoint_format is None:
+        # a plain state dict
+        return checkpoint
+    tensors = checkpoint["tensors"]
+    if checkpoint_format in ["bf16", "fp16"]:
+        return OrderedDict(
+            (k, v.float() if v.is_floating_point() else v) for k, v in tensors.items())
+
+    base_checkpoint = base_checkpoint or checkpoint["base_checkpoint"]
+    base_state_dict = _load_base(base_checkpoint)
+    state_dict = OrderedDict()
+    used = []
+    for k, v in tensors.items():
+        if isinstance(v, dict):
+            base = base_state_dict[_base_key(k)]
+            state_dict[k] = _decode_delta(v, base)
+            used.append(base)
+        else:
+            state_dict[k] = v
+    checksum = _checksum(used)
+    if abs(checksum - checkpoint["base_checksum"]) > 1e-6 * max(1.0, abs(checksum)):
+        raise ValueError("{} was written against other weights than {}".format(
+            path, base_checkpoint))
+    return state_dict
+
+
+class _SkipInit(TorchFunctionMode):
+    """Skips the in-place initialization of tensors, which means nothing on
+    the meta device. normal_ has no meta kernel, and torch sets up its Python
+    fallbacks on the first call, which takes longer than initializing BERT
+    base for real."""
+
+    init_ops = {"normal_", "uniform_", "zero_", "fill_"}
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        if getattr(func, "__name__", None) in self.init_ops:
+            # Tensor methods and torch.nn.init functions, which pass it by name
+            return args[0] if args else kwargs["tensor"]
+        return func(*args, **(kwargs or {}))
+
+
+def build_from_checkpoint(build, init_checkpoint, strict=True, skip_init=True):
+    """The model `build()` returns, with the weights of the fine-tuned
+    checkpoint at `init_checkpoint` (in any of `checkpoint_formats`).
+
+    With `skip_init`, the model is built on the meta device, so none of its
+    layers is randomly initialized only to be overwritten, and it takes the
+    memory-mapped tensors of the checkpoint as its weights without copying
+    them. If the checkpoint lacks some of the weights (with `strict=False`)
+    the model is built and initialized as usual instead. The `module.`
+    prefix of DataParallel checkpoints is dropped in place.
+    """
+    state_dict = load_checkpoint(init_checkpoint)
+    consume_prefix_in_state_dict_if_present(state_dict, 'module.')
+    if skip_init:
+        with torch.device('meta'), _SkipInit():
+            model = build()
+        model.load_state_dict(state_dict, strict=strict, assign=True)
+        if not any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers())):
+            return model
+    model = build()
+    model.load_state_dict(state_dict, strict=strict)
+    return model
+
+
+def snapshot_state_dict(model):
+    """A copy of the state dict of `model` in CPU memory, which the training
+    can go on changing the weights of."""
+    state_dict = model.state_dict()
+    snapshot = OrderedDict(
+        (k, v.detach().to("cpu", copy=True)) for k, v in state_dict.items())
+    # quantized layers need the serialization versions to load
+    snapshot._metadata = getattr(state_dict, "_metadata", None)
+    return snapshot
+
+
+def atomic_save(obj, path):
+    """torch.save to `path` through a temporary file, so `path` is either the
+    previous file or the complete new one, also if the process dies midway."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as writer:
+        torch.save(obj, writer)
+        writer.flush()
+        os.fsync(writer.fileno())
+    os.replace(tmp_path, path)
+
+
+def _link_or_copy(src, dst):
+    """Atomically points `dst` at the contents of `src`, sharing the file when
+    the file system supports hard links."""
+    tmp_path = dst + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointWriter(object):
+    """Saves checkpoint_<step>.bin and best_checkpoint.bin to `output_dir`
+    without blocking the training on the disk.
+
+    `save` copies the weights to CPU memory and hands them to a background
+    thread, which writes them atomically. The training only waits for the
+    copy, and for the previous checkpoint if it is still being written, so
+    one snapshot is in memory at a time. The stall is logged for every save.
+
+    Of the checkpoint_<step>.bin files only the `keep_last` latest and the
+    `keep_best` best by the task metric are kept (-1 keeps all of them).
+    best_checkpoint.bin is the best one so far, as before, and is a hard link
+    to its checkpoint_<step>.bin where the file system allows it.
+
+    The files are in `checkpoint_format` (see `compact_state_dict`); delta
+    checkpoints are written against the BERT pretrain weights at
+    `base_checkpoint`, which are kept in memory for it.
+
+    A checkpoint is only the best one if it beats `best_metric`, the best
+    metric of the run before it. Saving the same step again replaces its
+    checkpoint.
+    """
+
+    def __init__(self, output_dir, keep_last=3, keep_best=1,
+                 checkpoint_format="fp32", base_checkpoint=None, best_metric=None):
+        self.output_dir = output_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.checkpoint_format = checkpoint_format
+        self.base_checkpoint = base_checkpoint
+        self.base_state_dict = None
+        if checkpoint_format == "delta":
+            if base_checkpoint is None or "checkpoint" in base_checkpoint:
+                raise ValueError("Delta checkpoints need the BERT pretrain weights as "
+                                 "init_checkpoint, got {}".format(base_checkpoint))
+            self.base_state_dict = _load_base(base_checkpoint)
+        self.best_metric = best_metric
+        # global_step -> metric of the checkpoint_<step>.bin files on disk,
+        # oldest first
+        self.checkpoints = OrderedDict()
+        self.error = None
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def path(self, global_step):
+        return os.path.join(self.output_dir, "checkpoint_" + str(global_step) + ".bin")
+
+    def save(self, model, global_step, metric):
+        """Queues the weights of `model` after `global_step`, which scored
+        `metric` (higher is better), and returns the seconds the caller was
+        held up."""
+        start = time.time()
+        self.wait()
+        snapshot = snapshot_state_dict(model)
+        is_best = self.best_metric is None or metric > self.best_metric
+        if is_best:
+            self.best_metric = metric
+        self.pending.put((snapshot, global_step, metric, is_best))
+        stall = time.time() - start
+        logger.info("checkpoint_%d.bin: training stalled %.2fs, written in the background",
+                    global_step, stall)
+        return stall
+
+    def wait(self):
+        """Blocks until every queued checkpoint is on disk."""
+        self.pending.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self.pending.put(None)
+        self.thread.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def _write(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            snapshot, global_step, metric, is_best = item
+            del item
+            try:
+                start = time.time()
+                atomic_save(compact_state_dict(snapshot, self.checkpoint_format,
+                                               self.base_checkpoint, self.base_state_dict),
+                            self.path(global_step))
+                if is_best:
+                    _link_or_copy(self.path(global_step),
+                                  os.path.join(self.output_dir, "best_checkpoint.bin"))
+                # with gradient accumulation, a step is evaluated once per batch
+                self.checkpoints.pop(global_step, None)
+                self.checkpoints[global_step] = metric
+                self._remove_old()
+                logger.info("checkpoint_%d.bin: written in %.2fs", global_step,
+                            time.time() - start)
+            except Exception as e:
+                self.error = e
+            finally:
+                del snapshot
+                self.pending.task_done()
+
+    def _remove_old(self):
+        if self.keep_last < 0 or self.keep_best < 0:
+            return
+        steps = list(self.checkpoints)
+        keep = set(steps[max(0, len(steps) - self.keep_last):])
+        by_metric = sorted(steps, key=lambda step: self.checkpoints[step], reverse=True)
+        keep.update(by_metric[:self.keep_best])
+        for step in steps:
+            if step not in keep:
+                try:
+                    os.remove(self.path(step))
+                except FileNotFoundError:
+                    pass
+                del self.checkpoints[step]
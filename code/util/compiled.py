@@ -0,0 +1,79 @@
+# coding=utf-8
+
+"""Compiled inference on a fixed set of input shapes."""
+
+from __future__ import absolute_import, division, print_function
+
+import bisect
+import time
+
+import torch
+from torch._dynamo.utils import counters
+
+from util.export import InferenceModel
+
+
+def compiled_graphs():
+    """Number of graphs torch.compile has built in this process so far."""
+    return counters["stats"]["unique_graphs"]
+
+
+class BucketedModel(object):
+    """Runs a model compiled with torch.compile on batches padded up to a
+    few fixed shapes.
+
+    Every batch is padded to `batch_size` rows and to the shortest of
+    `buckets` that fits its sequence length, so after `warmup` compiles one
+    graph per bucket nothing is compiled again. The padded inputs are
+    written into buffers allocated once per bucket on `device`. It is
+    called like `util.export.InferenceModel`,
+    (input_ids, segment_ids, input_mask, context_ids) -> logits or score,
+    and the outputs of the padding rows are dropped.
+    """
+
+    def __init__(self, model, device, batch_size, buckets=(32, 64, 96, 128)):
+        self.model = InferenceModel(model).eval()
+        self.compiled = torch.compile(self.model, dynamic=False)
+        self.batch_size = batch_size
+        self.buckets = sorted(buckets)
+        # torch.compile keeps this many graphs of a function at most
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, len(self.buckets))
+        self.buffers = {}
+        for seq_length in self.buckets:
+            self.buffers[seq_length] = [
+                torch.zeros(batch_size, seq_length, dtype=torch.long, device=device)
+                for _ in range(3)] + \
+                [torch.zeros(batch_size, 1, dtype=torch.long, device=device)]
+        # seconds spent compiling each bucket in warmup
+        self.compile_time = {}
+
+    def bucket(self, seq_length):
+        """The sequence length a batch of `seq_length` is padded to."""
+        i = bisect.bisect_left(self.buckets, seq_length)
+        if i == len(self.buckets):
+            raise ValueError("Sequence length {} is longer than the largest bucket ({})".format(
+                seq_length, self.buckets[-1]))
+        return self.buckets[i]
+
+    def warmup(self):
+        """Compiles the graph of every bucket ahead of the first batch."""
+        # the graphs are specialized to the grad mode, so it is always the same
+        with torch.inference_mode():
+            for seq_length, buffers in self.buffers.items():
+                start = time.time()
+                self.compiled(*buffers)
+                self.compile_time[seq_length] = time.time() - start
+
+    def __call__(self, input_ids, segment_ids, input_mask, context_ids):
+        n_rows, seq_length = input_ids.shape
+        if n_rows > self.batch_size:
+            raise ValueError("Batch of {} rows is larger than the batch size ({})".format(
+                n_rows, self.batch_size))
+        buffers = self.buffers[self.bucket(seq_length)]
+        for buffer, x in zip(buffers, [input_ids, segment_ids, input_mask, context_ids]):
+            # the padding rows and positions are masked out
+            buffer.zero_()
+            buffer[:n_rows, :x.size(1)].copy_(x)
+        with torch.inference_mode():
+            return self.compiled(*buffers)[:n_rows]
@@ -0,0 +1,242 @@
+# coding=utf-8
+
+"""Batching of the padded feature tensors."""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import queue
+import threading
+import time
+
+import torch
+from torch.utils.data.sampler import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """Groups the indices drawn by `sampler` into batches of similar length.
+
+    The indices of `bucket_size` consecutive batches are pooled, sorted by
+    `seq_lens` and cut into batches, which are yielded in random order. The
+    examples seen in an epoch are exactly the ones `sampler` draws, so e.g.
+    the class balancing of a `WeightedRandomSampler` is kept; only which of
+    them share a batch changes. The batch order is drawn from `generator`
+    (the global generator if None), like the torch samplers do.
+    """
+
+    def __init__(self, sampler, seq_lens, batch_size, bucket_size=100,
+                 drop_last=False, generator=None):
+        self.sampler = sampler
+        self.seq_lens = seq_lens.view(-1)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __iter__(self):
+        pool = []
+        for index in self.sampler:
+            pool.append(index)
+            if len(pool) == self.batch_size * self.bucket_size:
+                for batch in self._batches(pool):
+                    yield batch
+                pool = []
+        if pool:
+            for batch in self._batches(pool):
+                yield batch
+
+    def _batches(self, pool):
+        pool = torch.tensor(pool, dtype=torch.long)
+        pool = pool[torch.argsort(self.seq_lens[pool])]
+        batches = list(torch.split(pool, self.batch_size))
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        for i in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[i].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class FeatureBatchDataset(object):
+    """The feature tensors, indexed a whole batch at a time.
+
+    Indexing with a list of example indices gathers each field with a
+    single `index_select`, already trimmed to the longest sequence of the
+    batch, instead of indexing every example and collating them again.
+    Use it with a batch sampler and `batch_size=None` in the `DataLoader`.
+    """
+
+    def __init__(self, input_ids, input_mask, segment_ids, label_ids,
+                 seq_lens, context_ids):
+        self.input_ids = input_ids
+        self.input_mask = input_mask
+        self.segment_ids = segment_ids
+        self.label_ids = label_ids
+        self.seq_lens = seq_lens
+        self.context_ids = context_ids
+
+    def __len__(self):
+        return self.input_ids.size(0)
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        seq_lens = self.seq_lens.index_select(0, indices)
+        max_seq_len = int(seq_lens.max())
+        return (self.input_ids[:, :max_seq_len].index_select(0, indices),
+                self.input_mask[:, :max_seq_len].index_select(0, indices),
+                self.segment_ids[:, :max_seq_len].index_select(0, indices),
+                self.label_ids.index_select(0, indices),
+                seq_lens,
+                self.context_ids.index_select(0, indices))
+
+
+def batch_to_device(batch, device, non_blocking=False):
+    """Moves the tensors of a batch to `device` and widens the compactly
+    stored integer fields to the type the models take there. Float labels
+    (scores) are kept as they are."""
+    widened = []
+    for tensor in batch:
+        tensor = tensor.to(device, non_blocking=non_blocking)
+        if not tensor.is_floating_point():
+            tensor = tensor.long()
+        widened.append(tensor)
+    return tuple(widened)
+
+
+class Prefetcher(object):
+    """Iterates `loader` with the batches already on `device`.
+
+    A background thread draws up to `depth` batches ahead of the one being
+    used and moves them with `batch_to_device`. On CUDA they are pinned and
+    copied on a separate stream, so the copy of batch k+1 overlaps the
+    compute of batch k. With `depth=0` the batches are prepared inline.
+
+    `wait_time` is the time spent waiting for a batch, `compute_time` the
+    time between getting a batch and asking for the next one, both summed
+    over all iterations. Time spent in `pause()` between two batches, e.g.
+    an evaluation, is counted in `paused_time` instead of `compute_time`.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0.0
+        self.compute_time = 0.0
+        self.paused_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def wait_fraction(self):
+        """The fraction of the iteration time spent waiting for data."""
+        total = self.wait_time + self.compute_time
+        if total == 0:
+            return 0.0
+        return self.wait_time / total
+
+    @contextlib.contextmanager
+    def pause(self):
+        """Leaves the time spent in the block out of `compute_time`."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.paused_time += time.time() - start
+
+    def __iter__(self):
+        if self.depth > 0:
+            batches = self._prefetch()
+        else:
+            batches = (batch_to_device(batch, self.device) for batch in self.loader)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    self.wait_time += time.time() - start
+                    return
+                ready = time.time()
+                self.wait_time += ready - start
+                paused_time = self.paused_time
+                yield batch
+                self.compute_time += time.time() - ready - (self.paused_time - paused_time)
+        finally:
+            batches.close()
+
+    def _prefetch(self):
+        use_cuda = self.device.type == "cuda"
+        stream = torch.cuda.Stream(self.device) if use_cuda else None
+        ready = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    event = None
+                    if use_cuda:
+                        with torch.cuda.stream(stream):
+                            batch = batch_to_device([t.pin_memory() for t in batch],
+                                                    self.device, non_blocking=True)
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    else:
+                        batch = batch_to_device(batch, self.device)
+                    if not put((batch, event, None)):
+                        return
+                put((None, None, None))
+            except Exception as error:
+                put((None, None, error))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, event, error = ready.get()
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # the copies were allocated on the side stream
+                    for tensor in batch:
+                        tensor.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+class PaddingStats(object):
+    """Counts real and padded tokens of the batches fed to the model."""
+
+    def __init__(self):
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def update(self, input_ids, seq_lens):
+        self.tokens += int(seq_lens.sum())
+        self.padded_tokens += input_ids.numel()
+
+    @property
+    def padding_ratio(self):
+        """The fraction of the batched positions that are padding."""
+        if self.padded_tokens == 0:
+            return 0.0
+        return 1.0 - self.tokens / self.padded_tokens
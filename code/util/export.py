@@ -0,0 +1,105 @@
+# coding=utf-8
+
+"""Inference-only export of the context-aware models to TorchScript and ONNX."""
+
+from __future__ import absolute_import, division, print_function
+
+import torch
+import torch.nn as nn
+
+input_names = ["input_ids", "segment_ids", "input_mask", "context_ids"]
+output_names = ["output"]
+# every input is (batch, seq) except the (batch, 1) context ids
+dynamic_axes = {
+    "input_ids": {0: "batch", 1: "sequence"},
+    "segment_ids": {0: "batch", 1: "sequence"},
+    "input_mask": {0: "batch", 1: "sequence"},
+    "context_ids": {0: "batch"},
+    "output": {0: "batch"},
+}
+
+
+class InferenceModel(nn.Module):
+    """Wraps a `QACGBertForSequenceClassification`, `QACGBertForSequenceScore`
+    or `CGBertForSequenceClassification` behind a plain tensor signature,
+    (input_ids, segment_ids, input_mask, context_ids) -> logits or score.
+
+    Without labels the models return a single tensor and skip the attention
+    maps, so the forward pass can be traced. The wrapped model should not
+    have the LRP hooks installed (`init_lrp=False`).
+    """
+
+    def __init__(self, model):
+        super(InferenceModel, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, segment_ids, input_mask, context_ids):
+        return self.model(input_ids, segment_ids, input_mask, None,
+                          context_ids=context_ids)
+
+
+def random_inputs(model, batch_size, seq_length):
+    """Inputs of the given shape for `model`, with random tokens, contexts
+    and padding; the first row is never padded."""
+    vocab_size = model.bert.embeddings.word_embeddings.num_embeddings
+    input_ids = torch.randint(1, vocab_size, (batch_size, seq_length))
+    segment_ids = torch.zeros(batch_size, seq_length, dtype=torch.long)
+    seq_lens = torch.randint(1, seq_length + 1, (batch_size, 1))
+    seq_lens[0] = seq_length
+    input_mask = (torch.arange(seq_length).unsqueeze(0) < seq_lens).long()
+    input_ids = input_ids * input_mask
+    num_contexts = model.bert.context_embeddings.num_embeddings
+    context_ids = torch.randint(0, num_contexts, (batch_size, 1))
+    return input_ids, segment_ids, input_mask, context_ids
+
+
+def to_torchscript(model, example_inputs):
+    """Traces `model` in eval mode into a TorchScript module taking
+    `input_names`. Batch size and sequence length stay dynamic.
+
+    The model is traced once, so the attention is split into the query
+    blocks of the example length (see `attention_chunk_size`); example
+    inputs no longer than the chunk size give a single block for any
+    length.
+    """
+    model = InferenceModel(model).eval()
+    with torch.no_grad():
+        # the trace checker compares tensor constants (the cached context
+        # table, the gate rows) by position and reports false mismatches;
+        # compare the outputs with max_abs_diff instead
+        return torch.jit.trace(model, example_inputs, check_trace=False)
+
+
+def to_onnx(model, example_inputs, path, opset_version=17):
+    """Exports `model` in eval mode to an ONNX file at `path`, with dynamic
+    batch and sequence axes. Needs the `onnx` package."""
+    model = InferenceModel(model).eval()
+    with torch.no_grad():
+        # the TorchScript based exporter, which takes dynamic_axes
+        torch.onnx.export(model, example_inputs, path,
+                          input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version,
+                          dynamo=False)
+
+
+def onnx_session(path):
+    """An ONNX Runtime CPU session for an exported model, called like the
+    model with torch tensors. Needs the `onnxruntime` package."""
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def run(*inputs):
+        outputs = session.run(None, {name: x.numpy() for name, x in zip(input_names, inputs)})
+        return torch.from_numpy(outputs[0])
+    return run
+
+
+def max_abs_diff(model, exported, batches):
+    """The largest absolute difference between the outputs of `model`, run
+    eagerly, and `exported` over `batches` of inputs."""
+    model = InferenceModel(model).eval()
+    diff = 0.0
+    with torch.no_grad():
+        for inputs in batches:
+            diff = max(diff, (model(*inputs) - exported(*inputs)).abs().max().item())
+    return diff
@@ -0,0 +1,264 @@
+# coding=utf-8
+
+"""Conversion of examples into padded BERT input arrays."""
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# names of the arrays returned by `convert_examples_to_features`
+feature_names = ["input_ids", "input_mask", "segment_ids", "label_ids",
+                 "seq_lens", "context_ids"]
+
+# part of the feature cache key; bump it whenever the tokenizers or the
+# conversion change the features they produce, so stale caches are rebuilt
+# 2: compact dtypes
+_CACHE_VERSION = 2
+
+
+def truncate_seq_pair(tokens_a, tokens_b, max_length):
+    """Truncates a sequence pair in place to the maximum length."""
+
+    # This is a simple heuristic which will always truncate the longer sequence
+    # one token at a time. This makes more sense than truncating an equal percent
+    # of tokens from each, since if one sequence is very short then each token
+    # that's truncated likely contains more information than a longer sequence.
+    while True:
+        total_length = len(tokens_a) + len(tokens_b)
+        if total_length <= max_length:
+            break
+        if len(tokens_a) > len(tokens_b):
+            tokens_a.pop()
+        else:
+            tokens_b.pop()
+
+
+def convert_examples_to_features(examples, max_seq_length, tokenizer,
+                                 max_context_length, context_standalone,
+                                 context_id_map, label_map=None,
+                                 num_workers=1, chunk_size=256):
+    """Converts `InputExample`s into padded arrays.
+
+    Args:
+        examples: `InputExample`s, `text_b` holds the context (aspect).
+        context_id_map: maps the `text_b` of an example to its context id.
+        context_standalone: if set, the context is not appended to the inputs.
+        label_map: maps labels to class ids. Without it the labels are
+            taken as float scores.
+        num_workers: number of processes to convert with. The examples are
+            split into chunks of `chunk_size`, which are converted in
+            parallel and concatenated in order.
+
+    Returns:
+        (input_ids, input_mask, segment_ids, label_ids, seq_lens, context_ids)
+        as NumPy arrays, in the order the models and data loaders use. They
+        are stored compactly: token ids as int16 when the vocab allows it
+        (int32 otherwise), masks and segment ids as uint8, context ids as
+        uint8, class ids as int8 and scores as float32, and are widened per
+        batch by `util.data.batch_to_device`.
+    """
+    rows = [(example.text_a, example.text_b, example.label) for example in examples]
+    chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+    input_ids_dtype = _smallest_int_dtype(max(tokenizer.vocab.values()))
+    settings = (tokenizer, input_ids_dtype, max_seq_length, max_context_length,
+                context_standalone, context_id_map, label_map)
+
+    if num_workers > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(min(num_workers, len(chunks)),
+                                    initializer=_init_worker, initargs=(settings,))
+        try:
+            features = list(tqdm(pool.imap(_convert_chunk, chunks), total=len(chunks)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(settings)
+        features = [_convert_chunk(chunk) for chunk in tqdm(chunks)]
+
+    if not features:
+        features = [_convert_chunk([])]
+    return tuple(np.concatenate(arrays, axis=0) for arrays in zip(*features))
+
+
+def cached_convert_examples_to_features(cache_dir, data_name, vocab_file,
+                                        task_name, examples, max_seq_length,
+                                        tokenizer, max_context_length,
+                                        context_standalone, context_id_map,
+                                        label_map=None, num_workers=1):
+    """`convert_examples_to_features` backed by an on-disk cache.
+
+    The features are stored as `.npy` files under `cache_dir`, keyed by
+    `data_name` (e.g. the data file), the contents of `vocab_file`, the
+    tokenizer casing, the conversion settings and `_CACHE_VERSION`. A hit is memory-mapped
+    copy-on-write, so nothing is read or copied until it is used. The cache
+    also records a digest of the cached examples: if `examples` only append
+    rows to them, just the new rows are converted and added, otherwise the
+    features are rebuilt. Without `cache_dir` this just converts.
+    """
+    def convert(examples):
+        return convert_examples_to_features(
+            examples, max_seq_length, tokenizer, max_context_length,
+            context_standalone, context_id_map, label_map=label_map,
+            num_workers=num_workers)
+
+    if cache_dir is None:
+        return convert(examples)
+
+    with open(vocab_file, "rb") as reader:
+        vocab_digest = hashlib.sha1(reader.read()).hexdigest()
+    key = json.dumps([
+        _CACHE_VERSION, data_name, vocab_digest, tokenizer.basic_tokenizer.do_lower_case,
+        max_seq_length, max_context_length, bool(context_standalone), task_name,
+        sorted(context_id_map.items()),
+        None if label_map is None else sorted(label_map.items())])
+    cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+    meta_file = os.path.join(cache_path, "meta.json")
+
+    features = None
+    n_cached = 0
+    if os.path.exists(meta_file):
+        with open(meta_file, "r") as reader:
+            meta = json.load(reader)
+        if meta["n_rows"] <= len(examples) and \
+                _examples_digest(examples[:meta["n_rows"]]) == meta["digest"]:
+            n_cached = meta["n_rows"]
+            features = tuple(
+                np.load(os.path.join(cache_path, name + ".npy"), mmap_mode="c")
+                for name in feature_names)
+    if features is not None and n_cached == len(examples):
+        logger.info("Loaded %d cached features from %s", n_cached, cache_path)
+        return features
+
+    logger.info("Converting %d of %d examples, caching them in %s",
+                len(examples) - n_cached, len(examples), cache_path)
+    new_features = convert(examples[n_cached:])
+    if features is not None:
+        features = tuple(np.concatenate([cached, new], axis=0)
+                         for cached, new in zip(features, new_features))
+    else:
+        features = new_features
+
+    # the meta file is written last, so an interrupted write is rebuilt
+    os.makedirs(cache_path, exist_ok=True)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    for name, array in zip(feature_names, features):
+        _atomic_write(os.path.join(cache_path, name + ".npy"),
+                      lambda writer: np.save(writer, array), mode="wb")
+    meta = {"n_rows": len(examples), "digest": _examples_digest(examples),
+            "key": json.loads(key)}
+    _atomic_write(meta_file, lambda writer: json.dump(meta, writer), mode="w")
+    return features
+
+
+def _examples_digest(examples):
+    digest = hashlib.sha1()
+    for example in examples:
+        digest.update(json.dumps(
+            [example.text_a, example.text_b, example.label]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _atomic_write(path, write, mode):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode) as writer:
+        write(writer)
+    os.replace(tmp_path, path)
+
+
+# conversion settings of the current process, set by `_init_worker`
+_worker_settings = None
+
+
+def _init_worker(settings):
+    global _worker_settings
+    _worker_settings = settings
+
+
+def _convert_chunk(rows):
+    tokenizer, input_ids_dtype, max_seq_length, max_context_length, \
+        context_standalone, context_id_map, label_map = _worker_settings
+
+    n_rows = len(rows)
+    input_ids = np.zeros((n_rows, max_seq_length), dtype=input_ids_dtype)
+    input_mask = np.zeros((n_rows, max_seq_length), dtype=np.uint8)
+    segment_ids = np.zeros((n_rows, max_seq_length), dtype=np.uint8)
+    seq_lens = np.zeros((n_rows, 1), dtype=_smallest_int_dtype(max_seq_length))
+    context_ids = np.zeros((n_rows, max_context_length), dtype=np.uint8)
+    if label_map is not None:
+        label_ids = np.array([label_map[label] for _, _, label in rows],
+                             dtype=_smallest_int_dtype(max(label_map.values())))
+    else:
+        label_ids = np.array([label for _, _, label in rows], dtype=np.float32)
+
+    for i, (text_a, text_b, _) in enumerate(rows):
+        tokens_a = tokenizer.tokenize(text_a)
+
+        tokens_b = None
+        if text_b:
+            tokens_b = tokenizer.tokenize(text_b)
+        # the context id is only set when the context has any tokens
+        has_context = bool(tokens_b)
+
+        if tokens_b and not context_standalone:
+            # Modifies `tokens_a` and `tokens_b` in place so that the total
+            # length is less than the specified length.
+            # Account for [CLS], [SEP], [SEP] with "- 3"
+            truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
+        else:
+            # Account for [CLS] and [SEP] with "- 2"
+            if len(tokens_a) > max_seq_length - 2:
+                tokens_a = tokens_a[0:(max_seq_length - 2)]
+
+        # The convention in BERT is:
+        # (a) For sequence pairs:
+        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+        #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
+        # (b) For single sequences:
+        #  tokens:   [CLS] the dog is hairy . [SEP]
+        #  type_ids: 0   0   0   0  0     0 0
+        #
+        # Where "type_ids" are used to indicate whether this is the first
+        # sequence or the second sequence. The embedding vectors for `type=0` and
+        # `type=1` were learned during pre-training and are added to the wordpiece
+        # embedding vector (and position vector). This is not *strictly* necessary
+        # since the [SEP] token unambigiously separates the sequences, but it makes
+        # it easier for the model to learn the concept of sequences.
+        #
+        # For classification tasks, the first vector (corresponding to [CLS]) is
+        # used as as the "sentence vector". Note that this only makes sense because
+        # the entire model is fine-tuned.
+        tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
+        len_a = len(tokens)
+        if tokens_b and not context_standalone:
+            tokens += tokens_b + ["[SEP]"]
+
+        # The mask has 1 for real tokens and 0 for padding tokens, the rest
+        # of the row stays zero-padded.
+        seq_len = len(tokens)
+        input_ids[i, :seq_len] = tokenizer.convert_tokens_to_ids(tokens)
+        input_mask[i, :seq_len] = 1
+        segment_ids[i, len_a:seq_len] = 1
+        seq_lens[i, 0] = seq_len
+
+        if has_context:
+            # let us encode context into single int
+            context_ids[i, 0] = context_id_map[text_b]
+
+    return input_ids, input_mask, segment_ids, label_ids, seq_lens, context_ids
+
+
+def _smallest_int_dtype(max_value):
+    for dtype in [np.int8, np.int16, np.int32]:
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
@@ -7,9 +7,30 @@
 import math
 
 import torch
+import torch.nn.functional as F
 from torch.nn.utils import clip_grad_norm_
 from torch.optim import Optimizer
 
+try:
+    from torch.nn.utils import clip_grads_with_norm_, get_total_norm
+except ImportError:
+    # torch < 2.6, the two halves of clip_grad_norm_ are not public yet
+    def get_total_norm(tensors, foreach=None):
+        """The 2-norm of all of `tensors` together."""
+        norms = torch._foreach_norm(tensors) if foreach else [t.norm() for t in tensors]
+        return torch.stack(norms).norm()
+
+    def clip_grads_with_norm_(parameters, max_norm, total_norm, foreach=None):
+        """Scales the gradients of `parameters` by max_norm / total_norm if that
+        is below 1."""
+        grads = [p.grad for p in parameters]
+        clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+        if foreach:
+            torch._foreach_mul_(grads, clip_coef)
+        else:
+            for g in grads:
+                g.mul_(clip_coef)
+
 
 def warmup_cosine(x, warmup=0.002):
     if x < warmup:
@@ -33,6 +54,50 @@ SCHEDULES = {
 }
 
 
+# elements sharing one scale in the 8-bit optimizer state
+_BLOCK_SIZE = 256
+
+
+def _stochastic_bf16(x, generator):
+    """Rounds fp32 `x` to bfloat16, up or down at random in proportion to the
+    distance, so that updates smaller than the bfloat16 spacing (next_v
+    decays by only 1 - b2 per step) are kept on average."""
+    noise = torch.randint(0, 1 << 16, x.shape, dtype=torch.int32, device=x.device,
+                          generator=generator)
+    # bfloat16 is the upper half of the float32 bits
+    bits = (x.contiguous().view(torch.int32) + noise).bitwise_and_(-65536)
+    return bits.view(torch.float32).to(torch.bfloat16)
+
+
+def _quantize_blocks(x, levels, dtype, generator):
+    """Stochastically rounds the flat fp32 `x` (padded to whole blocks) to
+    integers in [-levels, levels] times the absolute maximum of their block
+    over `levels`. Returns the integers as `dtype` and the block scales."""
+    blocks = x.view(-1, _BLOCK_SIZE)
+    scale = blocks.abs().amax(dim=1, keepdim=True) / levels
+    noise = torch.rand(blocks.shape, device=x.device, generator=generator)
+    q = torch.floor(blocks / scale.clamp(min=torch.finfo(torch.float32).tiny) + noise)
+    return q.clamp_(-levels, levels).to(dtype).view(-1), scale.view(-1)
+
+
+def _dequantize_blocks(q, scale):
+    return (q.float().view(-1, _BLOCK_SIZE) * scale.unsqueeze(1)).view(-1)
+
+
+def _chunks(params, max_numel):
+    """Splits `params` into runs of at most `max_numel` elements (or single
+    larger parameters)."""
+    chunk, numel = [], 0
+    for p in params:
+        if chunk and numel + p.numel() > max_numel:
+            yield chunk
+            chunk, numel = [], 0
+        chunk.append(p)
+        numel += p.numel()
+    if chunk:
+        yield chunk
+
+
 class BERTAdam(Optimizer):
     """Implements BERT version of Adam algorithm with weight decay fix (and no ).
     Params:
@@ -46,10 +111,21 @@ class BERTAdam(Optimizer):
         e: Adams epsilon. Default: 1e-6
         weight_decay_rate: Weight decay. Default: 0.01
         max_grad_norm: Maximum norm for the gradients (-1 means no clipping). Default: 1.0
+        per_param_clip: clip the gradient of every parameter to max_grad_norm on
+            its own, as earlier versions did, instead of clipping the norm of all
+            the gradients together. Default: False
+        foreach: update all the parameters of a group with multi-tensor kernels
+            instead of one parameter at a time. Default: True
+        state_dtype: how next_m and next_v are stored between steps, 'fp32',
+            'bf16' (stochastically rounded, half the memory) or 'int8' (m and
+            sqrt(v) quantized in blocks of 256 elements, a quarter of the
+            memory). The update itself is always computed in fp32, a chunk
+            of parameters at a time. Default: 'fp32'
     """
     def __init__(self, params, lr, warmup=-1, t_total=-1, schedule='warmup_linear',
                  b1=0.9, b2=0.999, e=1e-6, weight_decay_rate=0.01,
-                 max_grad_norm=1.0):
+                 max_grad_norm=1.0, per_param_clip=False, foreach=True,
+                 state_dtype='fp32'):
         if not lr >= 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
         if schedule not in SCHEDULES:
@@ -62,10 +138,21 @@ class BERTAdam(Optimizer):
             raise ValueError("Invalid b2 parameter: {} - should be in [0.0, 1.0[".format(b2))
         if not e >= 0.0:
             raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(e))
+        if state_dtype not in ('fp32', 'bf16', 'int8'):
+            raise ValueError("Invalid state_dtype: {} - should be fp32, bf16 or int8".format(state_dtype))
         defaults = dict(lr=lr, schedule=schedule, warmup=warmup, t_total=t_total,
                         b1=b1, b2=b2, e=e, weight_decay_rate=weight_decay_rate,
                         max_grad_norm=max_grad_norm)
         super(BERTAdam, self).__init__(params, defaults)
+        self.per_param_clip = per_param_clip
+        self.foreach = foreach
+        # parameters are updated together in runs of this many elements, so
+        # the temporaries of the update stay small enough to be reused
+        self.chunk_numel = 1 << 22
+        self.state_dtype = state_dtype
+        # the stochastic rounding of the compact states draws from its own
+        # generators, so it leaves the dropout masks of the model unchanged
+        self._generators = {}
 
     def get_lr(self):
         lr = []
@@ -105,6 +192,166 @@ class BERTAdam(Optimizer):
                 # Exponential moving average of squared gradient values
                 state['exp_avg_sq'] = torch.zeros_like(p.data)
 
+    def _lr_scheduled(self, group, step):
+        if group['t_total'] != -1:
+            schedule_fct = SCHEDULES[group['schedule']]
+            return group['lr'] * schedule_fct(step/group['t_total'], group['warmup'])
+        return group['lr']
+
+    def _generator(self, device):
+        if device not in self._generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(torch.initial_seed())
+            self._generators[device] = generator
+        return self._generators[device]
+
+    def _init_state(self, p):
+        state = self.state[p]
+        state['step'] = 0
+        if self.state_dtype == 'int8':
+            n_blocks = (p.numel() + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+            # m and sqrt(v), flattened and padded to whole blocks
+            for key, dtype in [('next_m', torch.int8), ('next_v', torch.uint8)]:
+                state[key] = torch.zeros(n_blocks * _BLOCK_SIZE, dtype=dtype, device=p.device)
+                state[key + '_scale'] = torch.zeros(n_blocks, device=p.device)
+        else:
+            dtype = torch.bfloat16 if self.state_dtype == 'bf16' else p.dtype
+            # Exponential moving average of gradient values
+            state['next_m'] = torch.zeros_like(p.data, dtype=dtype)
+            # Exponential moving average of squared gradient values
+            state['next_v'] = torch.zeros_like(p.data, dtype=dtype)
+
+    def _load_moments(self, params):
+        """next_m and next_v of `params` in fp32. These are the stored tensors
+        themselves for fp32 states, or new ones to be written back with
+        `_store_moments` for compact ones."""
+        next_m, next_v = [], []
+        for p in params:
+            state = self.state[p]
+            if self.state_dtype == 'int8':
+                m = _dequantize_blocks(state['next_m'], state['next_m_scale'])
+                sqrt_v = state['next_v'].float()
+                # a stored 0 stands for anything below one step of its block,
+                # while m is quantized on its own scale; reading it as half a
+                # step keeps m / sqrt(v) bounded
+                sqrt_v.masked_fill_(state['next_v'] == 0, 0.5)
+                sqrt_v = (sqrt_v.view(-1, _BLOCK_SIZE) * state['next_v_scale'].unsqueeze(1)).view(-1)
+                next_m.append(m[:p.numel()].view_as(p))
+                next_v.append(sqrt_v[:p.numel()].square_().view_as(p))
+            elif self.state_dtype == 'bf16':
+                next_m.append(state['next_m'].float())
+                next_v.append(state['next_v'].float())
+            else:
+                next_m.append(state['next_m'])
+                next_v.append(state['next_v'])
+        return next_m, next_v
+
+    def _store_moments(self, params, next_m, next_v):
+        if self.state_dtype == 'fp32':
+            return
+        for p, m, v in zip(params, next_m, next_v):
+            state = self.state[p]
+            generator = self._generator(p.device)
+            if self.state_dtype == 'bf16':
+                state['next_m'].copy_(_stochastic_bf16(m, generator))
+                state['next_v'].copy_(_stochastic_bf16(v, generator))
+                continue
+            padding = (0, state['next_m'].numel() - p.numel())
+            state['next_m'], state['next_m_scale'] = _quantize_blocks(
+                F.pad(m.reshape(-1), padding), 127, torch.int8, generator)
+            # the square root spans half the range of v in log scale
+            state['next_v'], state['next_v_scale'] = _quantize_blocks(
+                F.pad(v.reshape(-1).sqrt(), padding), 255, torch.uint8, generator)
+
+    def _clip_global(self, groups):
+        """Scales all the gradients down together, so their total norm is at
+        most the max_grad_norm of their group."""
+        groups = [(group, params) for group, params in groups
+                  if group['max_grad_norm'] > 0 and params]
+        if not groups:
+            return
+        grads = [p.grad for _, params in groups for p in params]
+        total_norm = get_total_norm(grads, foreach=self.foreach)
+        for group, params in groups:
+            clip_grads_with_norm_(params, group['max_grad_norm'], total_norm,
+                                  foreach=self.foreach)
+
+    def _update_foreach(self, group, params):
+        """The update of `_update_single_tensor` for all of `params` at once."""
+        grads = [p.grad for p in params]
+        beta1, beta2 = group['b1'], group['b2']
+
+        # Add grad clipping
+        if self.per_param_clip and group['max_grad_norm'] > 0:
+            # what clip_grad_norm_ does for every parameter on its own
+            norms = torch.stack(torch._foreach_norm(grads))
+            clip_coefs = (group['max_grad_norm'] / (norms + 1e-6)).clamp(max=1.0)
+            torch._foreach_mul_(grads, clip_coefs.unbind())
+
+        next_m, next_v = self._load_moments(params)
+        torch._foreach_mul_(next_m, beta1)
+        torch._foreach_add_(next_m, grads, alpha=1 - beta1)
+        torch._foreach_mul_(next_v, beta2)
+        torch._foreach_addcmul_(next_v, grads, grads, value=1 - beta2)
+        denom = torch._foreach_sqrt(next_v)
+        torch._foreach_add_(denom, group['e'])
+        update = torch._foreach_div(next_m, denom)
+        self._store_moments(params, next_m, next_v)
+        if group['weight_decay_rate'] > 0.0:
+            # multiplied on its own, as a fused alpha= rounds differently
+            torch._foreach_add_(update, torch._foreach_mul(params, group['weight_decay_rate']))
+
+        # the schedule is evaluated once for all the parameters at the same step
+        by_step = {}
+        for p, u in zip(params, update):
+            by_step.setdefault(self.state[p]['step'], []).append((p, u))
+        for step, pairs in by_step.items():
+            lr_scheduled = self._lr_scheduled(group, step)
+            torch._foreach_mul_([u for _, u in pairs], lr_scheduled)
+            torch._foreach_sub_([p for p, _ in pairs], [u for _, u in pairs])
+        for p in params:
+            self.state[p]['step'] += 1
+
+    def _update_single_tensor(self, group, params):
+        for p in params:
+            grad = p.grad.data
+            state = self.state[p]
+            (next_m,), (next_v,) = self._load_moments([p])
+            beta1, beta2 = group['b1'], group['b2']
+
+            # Add grad clipping
+            if self.per_param_clip and group['max_grad_norm'] > 0:
+                clip_grad_norm_(p, group['max_grad_norm'])
+
+            # Decay the first and second moment running average coefficient
+            # In-place operations to update the averages at the same time
+            next_m.mul_(beta1).add_(grad, alpha=1 - beta1)
+            next_v.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            update = next_m / (next_v.sqrt() + group['e'])
+            self._store_moments([p], [next_m], [next_v])
+
+            # Just adding the square of the weights to the loss function is *not*
+            # the correct way of using L2 regularization/weight decay with Adam,
+            # since that will interact with the m and v parameters in strange ways.
+            #
+            # Instead we want ot decay the weights in a manner that doesn't interact
+            # with the m/v parameters. This is equivalent to adding the square
+            # of the weights to the loss with plain (non-momentum) SGD.
+            if group['weight_decay_rate'] > 0.0:
+                update += group['weight_decay_rate'] * p.data
+
+            lr_scheduled = self._lr_scheduled(group, state['step'])
+
+            update_with_lr = lr_scheduled * update
+            p.data.add_(-update_with_lr)
+
+            state['step'] += 1
+
+            # step_size = lr_scheduled * math.sqrt(bias_correction2) / bias_correction1
+            # bias_correction1 = 1 - beta1 ** state['step']
+            # bias_correction2 = 1 - beta2 ** state['step']
+
+    @torch.no_grad()
     def step(self, closure=None):
         """Performs a single optimization step.
 
@@ -114,62 +361,35 @@ class BERTAdam(Optimizer):
         """
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
+        groups = []
         for group in self.param_groups:
+            params = []
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
 
                 state = self.state[p]
 
                 # State initialization
                 if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['next_m'] = torch.zeros_like(p.data)
-                    # Exponential moving average of squared gradient values
-                    state['next_v'] = torch.zeros_like(p.data)
-
-                next_m, next_v = state['next_m'], state['next_v']
-                beta1, beta2 = group['b1'], group['b2']
-
-                # Add grad clipping
-                if group['max_grad_norm'] > 0:
-                    clip_grad_norm_(p, group['max_grad_norm'])
-
-                # Decay the first and second moment running average coefficient
-                # In-place operations to update the averages at the same time
-                next_m.mul_(beta1).add_(1 - beta1, grad)
-                next_v.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                update = next_m / (next_v.sqrt() + group['e'])
-
-                # Just adding the square of the weights to the loss function is *not*
-                # the correct way of using L2 regularization/weight decay with Adam,
-                # since that will interact with the m and v parameters in strange ways.
-                #
-                # Instead we want ot decay the weights in a manner that doesn't interact
-                # with the m/v parameters. This is equivalent to adding the square
-                # of the weights to the loss with plain (non-momentum) SGD.
-                if group['weight_decay_rate'] > 0.0:
-                    update += group['weight_decay_rate'] * p.data
-
-                if group['t_total'] != -1:
-                    schedule_fct = SCHEDULES[group['schedule']]
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-
-                update_with_lr = lr_scheduled * update
-                p.data.add_(-update_with_lr)
-
-                state['step'] += 1
+                    self._init_state(p)
+                params.append(p)
+            groups.append((group, params))
 
-                # step_size = lr_scheduled * math.sqrt(bias_correction2) / bias_correction1
-                # bias_correction1 = 1 - beta1 ** state['step']
-                # bias_correction2 = 1 - beta2 ** state['step']
+        if not self.per_param_clip:
+            self._clip_global(groups)
+        for group, params in groups:
+            if not params:
+                continue
+            if self.foreach:
+                for chunk in _chunks(params, self.chunk_numel):
+                    self._update_foreach(group, chunk)
+            else:
+                self._update_single_tensor(group, params)
 
         return loss
@@ -0,0 +1,36 @@
+# coding=utf-8
+
+"""Reduced precision execution of the models."""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+
+import torch
+import torch.nn as nn
+
+
+def autocast(device, precision="fp32"):
+    """The context to run the model forward passes in.
+
+    With "bf16" the matrix products run in bfloat16 under autocast on the
+    type of `device`. The models take the layer norm statistics, softmax and
+    sigmoid gates in fp32 and return fp32 outputs, so the losses and metrics
+    are computed as before. The backward pass should run outside of it.
+    """
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if precision == "bf16":
+        return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+    raise ValueError("Unsupported precision: %s" % precision)
+
+
+def quantize(model):
+    """A copy of `model` with int8 weights in all of its Linear layers.
+
+    Activations are quantized dynamically per batch, so no calibration data
+    is needed; the model runs on CPU only. Load a checkpoint saved from a
+    quantized model into `quantize(model)`, not into the fp32 model.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model, {nn.Linear}, dtype=torch.qint8, inplace=False)
@@ -65,17 +65,20 @@ class Sentihood_NLI_M_Processor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        train_data = pd.read_csv(os.path.join(data_dir, "train_NLI_M.tsv"),sep="\t").values
+        train_data = pd.read_csv(os.path.join(data_dir, "train_NLI_M.tsv"),sep="\t",
+                                 keep_default_na=False).values
         return self._create_examples(train_data, "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        dev_data = pd.read_csv(os.path.join(data_dir, "dev_NLI_M.tsv"),sep="\t").values
+        dev_data = pd.read_csv(os.path.join(data_dir, "dev_NLI_M.tsv"),sep="\t",
+                               keep_default_na=False).values
         return self._create_examples(dev_data, "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        test_data = pd.read_csv(os.path.join(data_dir, "test_NLI_M.tsv"),sep="\t").values
+        test_data = pd.read_csv(os.path.join(data_dir, "test_NLI_M.tsv"),sep="\t",
+                                keep_default_na=False).values
         return self._create_examples(test_data, "test")
 
     def get_labels(self):
@@ -1,10 +1,11 @@
 import os
 import random
 import logging
+import time
 
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
-from torch.utils.data.sampler import RandomSampler, SequentialSampler, WeightedRandomSampler
+from torch.utils.data.sampler import BatchSampler, RandomSampler, SequentialSampler, WeightedRandomSampler
 from tqdm import tqdm, trange
 
 from model.CGBERT import *
@@ -12,7 +13,12 @@ from model.QACGBERT import *
 from util.optimization import BERTAdam
 from util.processor import FiqaProcessor
 from util.tokenization import *
+from util.data import BucketBatchSampler, FeatureBatchDataset, PaddingStats, \
+    Prefetcher
+from util.features import cached_convert_examples_to_features
 from util.evaluation import *
+from util.precision import autocast
+from util.checkpoint import build_from_checkpoint
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
@@ -25,106 +31,6 @@ context_id_map_fiqa = {'stock': 0,
                        'economy': 3}
 
 
-class InputFeatures(object):
-    def __init__(self, input_ids, input_mask, segment_ids, score, seq_len, context_ids):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.score = score
-        self.seq_len = seq_len
-        self.context_ids = context_ids
-
-
-def truncate_seq_pair(tokens_a, tokens_b, max_length):
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
-def convert_examples_to_features(examples, max_seq_length,
-                                 tokenizer, max_context_length,
-                                 context_standalone, args):
-    features = []
-    for (ex_index, example) in enumerate(tqdm(examples)):
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-        # tokens of context
-        tokens_context = None
-        if example.text_b:
-            tokens_context = tokenizer.tokenize(example.text_b)
-
-        if tokens_b and not context_standalone:
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3"
-            truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-        else:
-            # Account for [CLS] and [SEP] with "- 2"
-            if len(tokens_a) > max_seq_length - 2:
-                tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-        tokens = []
-        segment_ids = []
-        tokens.append("[CLS]")
-        segment_ids.append(0)
-        for token in tokens_a:
-            tokens.append(token)
-            segment_ids.append(0)
-        tokens.append("[SEP]")
-        segment_ids.append(0)
-
-        if tokens_b and not context_standalone:
-            for token in tokens_b:
-                tokens.append(token)
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        context_ids = []
-        if tokens_context:
-            context_ids = [context_id_map_fiqa[example.text_b]]
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        seq_len = len(input_ids)
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        while len(context_ids) < max_context_length:
-            context_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(context_ids) == max_context_length
-
-        features.append(
-            InputFeatures(
-                input_ids=input_ids,
-                input_mask=input_mask,
-                segment_ids=segment_ids,
-                score=example.label,
-                seq_len=seq_len,
-                context_ids=context_ids))
-
-    return features
-
-
 def get_model_optimizer_tokenizer(model_type, vocab_file,
                                bert_config_file=None, init_checkpoint=None,
                                do_lower_case=True,
@@ -132,9 +38,13 @@ def get_model_optimizer_tokenizer(model_type, vocab_file,
                                learning_rate=None,
                                base_learning_rate=None,
                                warmup_proportion=None,
-                               init_lrp=False):
+                               init_lrp=False,
+                               checkpoint_every=0,
+                               checkpoint_attention=False,
+                               per_param_clip=False,
+                               optimizer_state="fp32"):
 
-    tokenizer = FullTokenizer(
+    tokenizer = FastFullTokenizer(
         vocab_file=vocab_file, do_lower_case=do_lower_case, pretrain=False)
     if bert_config_file is not None:
         bert_config = BertConfig.from_json_file(bert_config_file)
@@ -155,6 +65,8 @@ def get_model_optimizer_tokenizer(model_type, vocab_file,
     logger.info("*** Model Config ***")
     logger.info(bert_config.to_json_string())
     bert_config.vocab_size = len(tokenizer.vocab)
+    bert_config.checkpoint_every = checkpoint_every
+    bert_config.checkpoint_attention = checkpoint_attention
 
     # if model_type == "CGBERT":
     #     logger.info("model = CGBERT")
@@ -163,28 +75,23 @@ def get_model_optimizer_tokenizer(model_type, vocab_file,
     #                 init_weight=True)
     # elif model_type == "QACGBERT":
     logger.info("model = QACGBERT")
-    model = QACGBertForSequenceScore(
-                bert_config,
-                init_weight=True,
-                init_lrp=init_lrp)
+    def build():
+        return QACGBertForSequenceScore(
+                    bert_config,
+                    init_weight=True,
+                    init_lrp=init_lrp)
     # else:
     #     assert False
-    if init_checkpoint is not None:
+    if init_checkpoint is not None and "checkpoint" in init_checkpoint:
         logger.info("retraining with saved model.")
-        # only load fields that are avaliable
-        if "checkpoint" in init_checkpoint:
-            logger.info("loading a best checkpoint, not BERT pretrain.")
-            state_dict = torch.load(init_checkpoint, map_location='cpu')
-            from collections import OrderedDict
-            new_state_dict = OrderedDict()
-            for k, v in state_dict.items():
-                if k.startswith('module.'):
-                    name = k[7:] # remove 'module.' of dataparallel
-                    new_state_dict[name]=v
-                else:
-                    new_state_dict[k]=v
-            model.load_state_dict(new_state_dict)
-        else:
+        logger.info("loading a best checkpoint, not BERT pretrain.")
+        # built without the random initialization, on the checkpoint's weights
+        model = build_from_checkpoint(build, init_checkpoint)
+    else:
+        model = build()
+        if init_checkpoint is not None:
+            logger.info("retraining with saved model.")
+            # only load fields that are avaliable
             model.bert.load_state_dict(torch.load(init_checkpoint, map_location='cpu'), strict=False)
     no_decay = ['bias', 'gamma', 'beta']
     block_list = []
@@ -198,7 +105,9 @@ def get_model_optimizer_tokenizer(model_type, vocab_file,
     optimizer = BERTAdam(optimizer_parameters,
                         lr=learning_rate,
                         warmup=warmup_proportion,
-                        t_total=num_train_steps)
+                        t_total=num_train_steps,
+                        per_param_clip=per_param_clip,
+                        state_dtype=optimizer_state)
     return model, optimizer, tokenizer
 
 
@@ -265,52 +174,69 @@ def data_and_model_loader(device, n_gpu, args, sampler="randomWeight"):
                                    num_train_steps=num_train_steps,
                                    learning_rate=args.learning_rate,
                                    base_learning_rate=args.base_learning_rate,
-                                   warmup_proportion=args.warmup_proportion)
+                                   warmup_proportion=args.warmup_proportion,
+                                   checkpoint_every=args.checkpoint_every,
+                                   checkpoint_attention=args.checkpoint_attention,
+                                   per_param_clip=args.per_param_clip,
+                                   optimizer_state=args.optimizer_state)
 
     # training set
-    train_features = convert_examples_to_features(
+    train_features = cached_convert_examples_to_features(
+        args.feature_cache_dir, os.path.join(os.path.abspath(args.data_dir), "train"),
+        args.vocab_file, args.task_name,
         train_examples, args.max_seq_length,
         tokenizer, args.max_context_length,
-        args.context_standalone, args)
+        args.context_standalone, context_id_map_fiqa,
+        num_workers=args.num_workers)
 
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_examples))
     logger.info("  Batch size = %d", args.train_batch_size)
     logger.info("  Num steps = %d", num_train_steps)
 
-    all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-    all_score = torch.tensor([f.score for f in train_features], dtype=torch.float)
-    all_seq_len = torch.tensor([[f.seq_len] for f in train_features], dtype=torch.long)
-    all_context_ids = torch.tensor([f.context_ids for f in train_features], dtype=torch.long)
+    all_input_ids, all_input_mask, all_segment_ids, all_score, \
+        all_seq_len, all_context_ids = [torch.from_numpy(a) for a in train_features]
 
-    train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                               all_score, all_seq_len, all_context_ids)
+    train_data = FeatureBatchDataset(all_input_ids, all_input_mask, all_segment_ids,
+                                     all_score, all_seq_len, all_context_ids)
+    # the samplers run in the prefetch thread, while the training draws
+    # dropout masks from the global generator
+    sampler_generator = torch.Generator()
+    sampler_generator.manual_seed(args.seed)
     if args.local_rank == -1:
-        train_sampler = RandomSampler(train_data)
+        train_sampler = RandomSampler(train_data, generator=sampler_generator)
+    else:
+        train_sampler = DistributedSampler(train_data, seed=args.seed)
+    if args.bucket_size > 0:
+        train_batch_sampler = BucketBatchSampler(train_sampler, all_seq_len,
+                                                 args.train_batch_size,
+                                                 bucket_size=args.bucket_size,
+                                                 generator=sampler_generator)
     else:
-        train_sampler = DistributedSampler(train_data)
-    train_dataloader = DataLoader(train_data, sampler=train_sampler,
-                                  batch_size=args.train_batch_size)
+        train_batch_sampler = BatchSampler(train_sampler, args.train_batch_size,
+                                           drop_last=False)
+    # every item of the batch sampler is gathered as a whole batch
+    train_dataloader = DataLoader(train_data, sampler=train_batch_sampler,
+                                  batch_size=None)
 
     # test set
     test_examples = processor.get_test_examples(args.data_dir)
-    test_features = convert_examples_to_features(
+    test_features = cached_convert_examples_to_features(
+        args.feature_cache_dir, os.path.join(os.path.abspath(args.data_dir), "test"),
+        args.vocab_file, args.task_name,
         test_examples, args.max_seq_length,
         tokenizer, args.max_context_length,
-        args.context_standalone, args)
+        args.context_standalone, context_id_map_fiqa,
+        num_workers=args.num_workers)
 
-    all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-    all_score = torch.tensor([f.score for f in test_features], dtype=torch.float)
-    all_seq_len = torch.tensor([[f.seq_len] for f in test_features], dtype=torch.long)
-    all_context_ids = torch.tensor([f.context_ids for f in test_features], dtype=torch.long)
+    all_input_ids, all_input_mask, all_segment_ids, all_score, \
+        all_seq_len, all_context_ids = [torch.from_numpy(a) for a in test_features]
 
-    test_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                all_score, all_seq_len, all_context_ids)
-    test_dataloader = DataLoader(test_data, batch_size=args.eval_batch_size, shuffle=False)
+    test_data = FeatureBatchDataset(all_input_ids, all_input_mask, all_segment_ids,
+                                    all_score, all_seq_len, all_context_ids)
+    test_batch_sampler = BatchSampler(SequentialSampler(test_data), args.eval_batch_size,
+                                      drop_last=False)
+    test_dataloader = DataLoader(test_data, sampler=test_batch_sampler, batch_size=None)
 
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
@@ -323,32 +249,23 @@ def data_and_model_loader(device, n_gpu, args, sampler="randomWeight"):
 
 
 def evaluate(test_dataloader, model, device, n_gpu, nb_tr_steps, tr_loss, epoch,
-             global_step, output_log_file, global_best_acc, args):
+             global_step, output_log_file, global_best_acc, args,
+             checkpoint_writer=None):
 
     model.eval()
     test_loss, test_accuracy = 0, 0
     nb_test_steps, nb_test_examples = 0, 0
-    pbar = tqdm(test_dataloader, desc="Iteration")
+    batches = Prefetcher(test_dataloader, device, depth=args.prefetch_depth)
+    pbar = tqdm(batches, desc="Iteration")
     y_true, y_pred, score = [], [], []
     # we don't need gradient in this case.
-    with torch.no_grad():
+    with torch.no_grad(), autocast(device, args.precision):
         for _, batch in enumerate(pbar):
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
-            # truncate to save space and computing resource
+            # batches are already padded to their longest sequence and on device
             input_ids, input_mask, segment_ids, score, seq_lens, \
                 context_ids = batch
-            max_seq_lens = max(seq_lens)[0]
-            input_ids = input_ids[:,:max_seq_lens]
-            input_mask = input_mask[:,:max_seq_lens]
-            segment_ids = segment_ids[:,:max_seq_lens]
-
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-            segment_ids = segment_ids.to(device)
-            score = score.to(device)
-            seq_lens = seq_lens.to(device)
-            context_ids = context_ids.to(device)
 
             # intentially with gradient
             tmp_test_loss, pred_score, _, _, _, _ = \
@@ -405,45 +322,40 @@ def evaluate(test_dataloader, model, device, n_gpu, nb_tr_steps, tr_loss, epoch,
         writer.write("\n")
 
     # save for each time point
-    if args.output_dir:
-        torch.save(model.state_dict(), args.output_dir + "checkpoint_" + str(global_step) + ".bin")
-        if test_accuracy > global_best_acc:
-            torch.save(model.state_dict(), args.output_dir + "best_checkpoint.bin")
-            global_best_acc = test_accuracy
+    # test_accuracy is not computed for scores, lower test loss is better
+    metric = -test_loss
+    if checkpoint_writer is not None:
+        checkpoint_writer.save(model, global_step, metric)
+    global_best_acc = max(global_best_acc, metric)
 
     return global_best_acc
 
 
 def step_train(train_dataloader, test_dataloader, model, optimizer,
                device, n_gpu, evaluate_interval, global_step,
-               output_log_file, epoch, global_best_acc, args):
+               output_log_file, epoch, global_best_acc, args,
+               checkpoint_writer=None):
     tr_loss = 0
     nb_tr_examples, nb_tr_steps = 0, 0
-    pbar = tqdm(train_dataloader, desc="Iteration")
+    padding_stats = PaddingStats()
+    start_time = time.time()
+    batches = Prefetcher(train_dataloader, device, depth=args.prefetch_depth)
+    pbar = tqdm(batches, desc="Iteration")
     for step, batch in enumerate(pbar):
         model.train()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
-        # truncate to save space and computing resource
+        # batches are already padded to their longest sequence and on device
         input_ids, input_mask, segment_ids, score, seq_lens, \
             context_ids = batch
-        max_seq_lens = max(seq_lens)[0]
-        input_ids = input_ids[:,:max_seq_lens]
-        input_mask = input_mask[:,:max_seq_lens]
-        segment_ids = segment_ids[:,:max_seq_lens]
-
-        input_ids = input_ids.to(device)
-        input_mask = input_mask.to(device)
-        segment_ids = segment_ids.to(device)
-        score = score.to(device)
-        seq_lens = seq_lens.to(device)
-        context_ids = context_ids.to(device)
-
-        loss, _, _, _, _, _ = \
-            model(input_ids, segment_ids, input_mask, seq_lens,
-                            device=device, labels=score,
-                            context_ids=context_ids)
+        padding_stats.update(input_ids, seq_lens)
+
+        with autocast(device, args.precision):
+            loss, _, _, _, _, _ = \
+                model(input_ids, segment_ids, input_mask, seq_lens,
+                                device=device, labels=score,
+                                context_ids=context_ids)
         if n_gpu > 1:
             loss = loss.mean() # mean() to average on multi-gpu.
         if args.gradient_accumulation_steps > 1:
@@ -460,7 +372,15 @@ def step_train(train_dataloader, test_dataloader, model, optimizer,
 
         if global_step % evaluate_interval == 0:
             logger.info("***** Evaluation Interval Hit *****")
-            global_best_acc = evaluate(test_dataloader, model, device, n_gpu, nb_tr_steps, tr_loss, epoch,
-                                       global_step, output_log_file, global_best_acc, args)
-
+            with batches.pause():
+                global_best_acc = evaluate(test_dataloader, model, device, n_gpu, nb_tr_steps, tr_loss, epoch,
+                                           global_step, output_log_file, global_best_acc, args,
+                                           checkpoint_writer)
+
+    logger.info("padding ratio = %.3f, %.0f training tokens/s",
+                padding_stats.padding_ratio,
+                padding_stats.tokens / (time.time() - start_time - batches.paused_time))
+    logger.info("data wait = %.1fs, compute = %.1fs (%.1f%% waiting)",
+                batches.wait_time, batches.compute_time,
+                100 * batches.wait_fraction)
     return global_step, global_best_acc
\ No newline at end of file
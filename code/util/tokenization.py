@@ -7,6 +7,9 @@
 from __future__ import absolute_import, division, print_function
 
 import collections
+import functools
+import re
+import sys
 import unicodedata
 
 import six
@@ -124,6 +127,43 @@ class FullTokenizer(object):
         return convert_tokens_to_ids(self.vocab, tokens)
 
 
+class FastFullTokenizer(FullTokenizer):
+    """Runs end-to-end tokenziation, with the same output as `FullTokenizer`.
+
+    WordPiece matching walks a prefix trie over the vocab and the word pieces
+    of the most recent `cache_size` distinct words are memoized, since the
+    same words come back for every aspect copy of a sentence.
+    """
+
+    def __init__(self, vocab_file, do_lower_case=True, pretrain=True,
+                 cache_size=2**16):
+        self.vocab = load_vocab(vocab_file, pretrain=pretrain)
+        self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
+        self.wordpiece_tokenizer = TrieWordpieceTokenizer(vocab=self.vocab)
+        self.cache_size = cache_size
+        self._build_cache()
+
+    def _build_cache(self):
+        self._tokenize_word = functools.lru_cache(maxsize=self.cache_size)(
+            lambda token: tuple(self.wordpiece_tokenizer.tokenize(token)))
+
+    def __getstate__(self):
+        # the cache is not picklable, worker processes start with an empty one
+        state = self.__dict__.copy()
+        del state["_tokenize_word"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_cache()
+
+    def tokenize(self, text):
+        split_tokens = []
+        for token in self.basic_tokenizer.tokenize(text):
+            split_tokens.extend(self._tokenize_word(token))
+        return split_tokens
+
+
 class BasicTokenizer(object):
     """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
@@ -139,60 +179,36 @@ class BasicTokenizer(object):
         """Tokenizes a piece of text."""
         text = convert_to_unicode(text)
         text = self._clean_text(text)
-        orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
-        for token in orig_tokens:
-            if self.do_lower_case:
-                token = token.lower()
-                token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
-
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
-        return output_tokens
+        # Chinese and other CJK text is written without spaces, so every CJK
+        # character is made a word of its own, as in the multilingual and
+        # Chinese BERT models.
+        text = self._tokenize_chinese_chars(text)
+        # lower casing, accent stripping and punctuation splitting never act
+        # across whitespace, so they run over the whole text at once.
+        if self.do_lower_case:
+            text = self._run_strip_accents(text.lower())
+        return whitespace_tokenize(" ".join(self._run_split_on_punc(text)))
 
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
+        if _is_ascii(text):
+            return text
         text = unicodedata.normalize("NFD", text)
-        output = []
-        for char in text:
-            cat = unicodedata.category(char)
-            if cat == "Mn":
-                continue
-            output.append(char)
-        return "".join(output)
+        return _char_class_re("nonspacing_mark").sub("", text)
 
     def _run_split_on_punc(self, text):
         """Splits punctuation on a piece of text."""
-        chars = list(text)
-        i = 0
-        start_new_word = True
-        output = []
-        while i < len(chars):
-            char = chars[i]
-            if _is_punctuation(char):
-                output.append([char])
-                start_new_word = True
-            else:
-                if start_new_word:
-                    output.append([])
-                start_new_word = False
-                output[-1].append(char)
-            i += 1
+        return [token for token in _char_class_re("punctuation", group=True).split(text)
+                if token]
 
-        return ["".join(x) for x in output]
+    def _tokenize_chinese_chars(self, text):
+        """Adds whitespace around any CJK character."""
+        return " ".join(_CJK_RE.split(text))
 
     def _clean_text(self, text):
         """Performs invalid character removal and whitespace cleanup on text."""
-        output = []
-        for char in text:
-            cp = ord(char)
-            if cp == 0 or cp == 0xfffd or _is_control(char):
-                continue
-            if _is_whitespace(char):
-                output.append(" ")
-            else:
-                output.append(char)
-        return "".join(output)
+        text = _char_class_re("control").sub("", text)
+        return _char_class_re("whitespace").sub(" ", text)
 
 
 class WordpieceTokenizer(object):
@@ -257,6 +273,70 @@ class WordpieceTokenizer(object):
         return output_tokens
 
 
+class TrieWordpieceTokenizer(WordpieceTokenizer):
+    """Runs WordPiece tokenization with a prefix trie over the vocab.
+
+    Gives the same greedy longest-match-first word pieces as
+    `WordpieceTokenizer`, in time linear in the length of each word.
+    """
+
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+        super(TrieWordpieceTokenizer, self).__init__(
+            vocab, unk_token=unk_token,
+            max_input_chars_per_word=max_input_chars_per_word)
+        # pieces starting a word and "##" continuation pieces live in separate
+        # tries, the latter without the "##" prefix. A node is a dict from
+        # characters to child nodes, the `None` key marks a vocab entry.
+        self.start_trie = {}
+        self.continuation_trie = {}
+        for piece in vocab:
+            if piece.startswith("##"):
+                node, chars = self.continuation_trie, piece[2:]
+            else:
+                node, chars = self.start_trie, piece
+            for char in chars:
+                node = node.setdefault(char, {})
+            node[None] = piece
+
+    def tokenize(self, text):
+        """Tokenizes a piece of text into its word pieces.
+
+        See `WordpieceTokenizer.tokenize`.
+        """
+
+        text = convert_to_unicode(text)
+
+        output_tokens = []
+        for token in whitespace_tokenize(text):
+            if len(token) > self.max_input_chars_per_word:
+                output_tokens.append(self.unk_token)
+                continue
+
+            start = 0
+            sub_tokens = []
+            while start < len(token):
+                node = self.start_trie if start == 0 else self.continuation_trie
+                cur_substr = None
+                end = start
+                for i in range(start, len(token)):
+                    node = node.get(token[i])
+                    if node is None:
+                        break
+                    if None in node:
+                        cur_substr = node[None]
+                        end = i + 1
+                if cur_substr is None:
+                    break
+                sub_tokens.append(cur_substr)
+                start = end
+
+            if cur_substr is None:
+                output_tokens.append(self.unk_token)
+            else:
+                output_tokens.extend(sub_tokens)
+        return output_tokens
+
+
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically contorl characters but we treat them
@@ -295,3 +375,111 @@ def _is_punctuation(char):
     if cat.startswith("P"):
         return True
     return False
+
+
+# This defines a "chinese character" as anything in the CJK Unicode block:
+#   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
+#
+# Note that the CJK Unicode block is NOT all Japanese and Korean characters,
+# despite its name. The modern Korean Hangul alphabet is a different block,
+# as is Japanese Hiragana and Katakana. Those alphabets are used to write
+# space-separated words, so they are not treated specially and handled
+# like all of the other languages.
+_CJK_RANGES = [
+    (0x4E00, 0x9FFF),
+    (0x3400, 0x4DBF),
+    (0x20000, 0x2A6DF),
+    (0x2A700, 0x2B73F),
+    (0x2B740, 0x2B81F),
+    (0x2B820, 0x2CEAF),
+    (0xF900, 0xFAFF),
+    (0x2F800, 0x2FA1F),
+]
+
+
+def _regex_char_class(ranges):
+    """Builds a regex matching a character in one of the sorted, inclusive
+    codepoint `ranges`.
+
+    `re` only compiles a character class into a lookup table when all of it
+    lies in the Basic Multilingual Plane, so codepoints above it go to a
+    second class behind a cheap range guard.
+    """
+    def char_class(ranges):
+        return "[%s]" % "".join("\\U%08x-\\U%08x" % (start, end) for start, end in ranges)
+
+    bmp = [(start, min(end, 0xffff)) for start, end in ranges if start <= 0xffff]
+    astral = [(max(start, 0x10000), end) for start, end in ranges if end > 0xffff]
+    alternatives = []
+    if bmp:
+        alternatives.append(char_class(bmp))
+    if astral:
+        alternatives.append("(?=[\\U00010000-\\U0010ffff])" + char_class(astral))
+    return "(?:%s)" % "|".join(alternatives)
+
+
+_CJK_RE = re.compile("(%s)" % _regex_char_class(sorted(_CJK_RANGES)))
+
+
+def _is_ascii(text):
+    try:
+        text.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _scan_char_classes():
+    """The codepoint ranges of the classes of `_char_class_re`, found by
+    classifying every codepoint. Takes a second or two."""
+    ranges = collections.defaultdict(list)
+
+    def add(class_name, cp):
+        class_ranges = ranges[class_name]
+        if class_ranges and class_ranges[-1][1] == cp - 1:
+            class_ranges[-1][1] = cp
+        else:
+            class_ranges.append([cp, cp])
+
+    for cp in range(sys.maxunicode + 1):
+        char = six.unichr(cp)
+        if cp == 0 or cp == 0xfffd or _is_control(char):
+            add("control", cp)
+        elif _is_whitespace(char):
+            add("whitespace", cp)
+        if _is_punctuation(char):
+            add("punctuation", cp)
+        if unicodedata.category(char) == "Mn":
+            add("nonspacing_mark", cp)
+    return {class_name: [tuple(r) for r in class_ranges]
+            for class_name, class_ranges in ranges.items()}
+
+
+_char_class_ranges = None
+_char_class_res = {}
+
+
+def _char_class_re(name, group=False):
+    """Returns a compiled regex matching one character of class `name`.
+
+    The classes are those of `_clean_text` ("control" and "whitespace"),
+    `_is_punctuation` ("punctuation") and `_run_strip_accents`
+    ("nonspacing_mark"). Applying one regex to a whole piece of text is much
+    faster than classifying it character by character in Python. The ranges
+    of the classes come from `util.char_classes`, or from a scan over all
+    codepoints if it was generated for another Unicode version than the one
+    of `unicodedata`; each regex is compiled on first use.
+    """
+    global _char_class_ranges
+    if (name, group) not in _char_class_res:
+        if _char_class_ranges is None:
+            from util import char_classes
+            if char_classes.unidata_version == unicodedata.unidata_version:
+                _char_class_ranges = char_classes.ranges
+            else:
+                _char_class_ranges = _scan_char_classes()
+        char_class = _regex_char_class(_char_class_ranges[name])
+        if group:
+            char_class = "(%s)" % char_class
+        _char_class_res[name, group] = re.compile(char_class)
+    return _char_class_res[name, group]
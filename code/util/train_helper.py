@@ -1,6 +1,7 @@
 import pickle
 import re
 import os
+import time
 
 import random
 import numpy as np
@@ -21,9 +22,9 @@ from model.QACGBERT import *
 
 from sklearn.metrics import f1_score, accuracy_score, roc_auc_score
 
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
-from torch.utils.data.sampler import RandomSampler, SequentialSampler, WeightedRandomSampler
+from torch.utils.data.sampler import BatchSampler, RandomSampler, SequentialSampler, WeightedRandomSampler
 from tqdm import tqdm, trange
 
 from util.optimization import BERTAdam
@@ -32,8 +33,13 @@ from util.processor import (Sentihood_NLI_M_Processor,
                             FiqaProcessor)
 
 from util.tokenization import *
+from util.features import cached_convert_examples_to_features
+from util.data import BucketBatchSampler, FeatureBatchDataset, PaddingStats, \
+    Prefetcher
 
 from util.evaluation import *
+from util.precision import autocast
+from util.checkpoint import build_from_checkpoint
 
 import logging
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s', 
@@ -80,147 +86,13 @@ context_id_map_fiqa_chinese = {"法务": 0, "并购": 1, "监管": 2, "风险":
 context_id_map_fiqa_chinese_1 = {"公司": 0, "经济": 1, "市场": 2, "股票": 3, "其他": 4}
 
 
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-class InputFeatures(object):
-    """A single set of features of data."""
-
-    def __init__(self, input_ids, input_mask, segment_ids, label_id, seq_len,
-                 context_ids):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.label_id = label_id
-        self.seq_len = seq_len
-        # extra fields to hold context
-        self.context_ids = context_ids
-
-def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer, max_context_length,
-                                 # if this is true, the context will not be
-                                 # appened into the inputs
-                                 context_standalone, args):
-    """Loads a data file into a list of `InputBatch`s."""
-
-    label_map = {}
-    for (i, label) in enumerate(label_list):
-        label_map[label] = i
-
-    features = []
-    for (ex_index, example) in enumerate(tqdm(examples)):
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-        # tokens of context
-        tokens_context = None
-        if example.text_b:
-            tokens_context = tokenizer.tokenize(example.text_b)
-
-        if tokens_b and not context_standalone:
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3"
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-        else:
-            # Account for [CLS] and [SEP] with "- 2"
-            if len(tokens_a) > max_seq_length - 2:
-                tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids: 0   0   0   0  0     0 0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambigiously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = []
-        segment_ids = []
-        tokens.append("[CLS]")
-        segment_ids.append(0)
-        for token in tokens_a:
-            tokens.append(token)
-            segment_ids.append(0)
-        tokens.append("[SEP]")
-        segment_ids.append(0)
-
-        if tokens_b and not context_standalone:
-            for token in tokens_b:
-                tokens.append(token)
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        context_ids = []
-        if tokens_context:
-            # let us encode context into single int
-            if args.task_name == "sentihood_NLI_M":
-                context_ids = [context_id_map_sentihood[example.text_b]]
-            elif args.task_name in ["fiqa_headline", "fiqa_post", "fiqa_acd"]:
-                context_ids = [context_id_map_fiqa_chinese[example.text_b]]
-            else:
-                context_ids = [context_id_map_semeval[example.text_b]]
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        seq_len = len(input_ids)
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        while len(context_ids) < max_context_length:
-            context_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(context_ids) == max_context_length
-
-        label_id = label_map[example.label]
-
-        features.append(
-                InputFeatures(
-                        input_ids=input_ids,
-                        input_mask=input_mask,
-                        segment_ids=segment_ids,
-                        label_id=label_id,
-                        seq_len=seq_len,
-                        # newly added context part
-                        context_ids=context_ids))
-    
-    return features
+def get_context_id_map(task_name):
+    if task_name == "sentihood_NLI_M":
+        return context_id_map_sentihood
+    elif task_name in ["fiqa_headline", "fiqa_post", "fiqa_acd"]:
+        return context_id_map_fiqa_chinese
+    else:
+        return context_id_map_semeval
 
 def make_weights_for_balanced_classes(labels, nclasses, fixed=False):
     if fixed:
@@ -262,10 +134,14 @@ def getModelOptimizerTokenizer(model_type, vocab_file,
                                learning_rate=None,
                                base_learning_rate=None,
                                warmup_proportion=None,
-                               init_lrp=False):
+                               init_lrp=False,
+                               checkpoint_every=0,
+                               checkpoint_attention=False,
+                               per_param_clip=False,
+                               optimizer_state="fp32"):
 
     # this is the model we develop
-    tokenizer = FullTokenizer(
+    tokenizer = FastFullTokenizer(
         vocab_file=vocab_file, do_lower_case=do_lower_case, pretrain=False)
     if bert_config_file is not None:
         bert_config = BertConfig.from_json_file(bert_config_file)
@@ -288,37 +164,34 @@ def getModelOptimizerTokenizer(model_type, vocab_file,
     # overwrite the vocab size to be exact. this also save space incase
     # vocab size is shrinked.
     bert_config.vocab_size = len(tokenizer.vocab)
+    bert_config.checkpoint_every = checkpoint_every
+    bert_config.checkpoint_attention = checkpoint_attention
     # model and optimizer
     if model_type == "CGBERT":
         logger.info("model = CGBERT")
-        model = CGBertForSequenceClassification(
-                    bert_config, len(label_list),
-                    init_weight=True)
+        def build():
+            return CGBertForSequenceClassification(
+                        bert_config, len(label_list),
+                        init_weight=True)
     elif model_type == "QACGBERT":
         logger.info("model = QACGBERT")
-        model = QACGBertForSequenceClassification(
-                    bert_config, len(label_list),
-                    init_weight=True,
-                    init_lrp=init_lrp)
+        def build():
+            return QACGBertForSequenceClassification(
+                        bert_config, len(label_list),
+                        init_weight=True,
+                        init_lrp=init_lrp)
     else:
         assert False
-    if init_checkpoint is not None:
+    if init_checkpoint is not None and "checkpoint" in init_checkpoint:
         logger.info("retraining with saved model.")
-        # only load fields that are avaliable
-        if "checkpoint" in init_checkpoint:
-            logger.info("loading a best checkpoint, not BERT pretrain.")
-            # we need to add handling logic specially for parallel gpu trainign
-            state_dict = torch.load(init_checkpoint, map_location='cpu')
-            from collections import OrderedDict
-            new_state_dict = OrderedDict()
-            for k, v in state_dict.items():
-                if k.startswith('module.'):
-                    name = k[7:] # remove 'module.' of dataparallel
-                    new_state_dict[name]=v
-                else:
-                    new_state_dict[k]=v
-            model.load_state_dict(new_state_dict)
-        else:
+        logger.info("loading a best checkpoint, not BERT pretrain.")
+        # built without the random initialization, on the checkpoint's weights
+        model = build_from_checkpoint(build, init_checkpoint)
+    else:
+        model = build()
+        if init_checkpoint is not None:
+            logger.info("retraining with saved model.")
+            # only load fields that are avaliable
             model.bert.load_state_dict(torch.load(init_checkpoint, map_location='cpu'), strict=False)
     no_decay = ['bias', 'gamma', 'beta']
     block_list = []
@@ -371,7 +244,9 @@ def getModelOptimizerTokenizer(model_type, vocab_file,
     optimizer = BERTAdam(optimizer_parameters,
                         lr=learning_rate,
                         warmup=warmup_proportion,
-                        t_total=num_train_steps)
+                        t_total=num_train_steps,
+                        per_param_clip=per_param_clip,
+                        state_dtype=optimizer_state)
     return model, optimizer, tokenizer
 
 def system_setups(args):
@@ -425,6 +300,7 @@ def system_setups(args):
 def data_and_model_loader(device, n_gpu, args, sampler="randomWeight"):
     processor = processors[args.task_name]()
     label_list = processor.get_labels()
+    label_map = {label: i for i, label in enumerate(label_list)}
 
     # training setup
     train_examples = None
@@ -444,60 +320,75 @@ def data_and_model_loader(device, n_gpu, args, sampler="randomWeight"):
                                    num_train_steps=num_train_steps,
                                    learning_rate=args.learning_rate,
                                    base_learning_rate=args.base_learning_rate,
-                                   warmup_proportion=args.warmup_proportion)
+                                   warmup_proportion=args.warmup_proportion,
+                                   checkpoint_every=args.checkpoint_every,
+                                   checkpoint_attention=args.checkpoint_attention,
+                                   per_param_clip=args.per_param_clip,
+                                   optimizer_state=args.optimizer_state)
 
     # training set
-    train_features = convert_examples_to_features(
-        train_examples, label_list, args.max_seq_length,
+    train_features = cached_convert_examples_to_features(
+        args.feature_cache_dir, os.path.join(os.path.abspath(args.data_dir), "train"),
+        args.vocab_file, args.task_name,
+        train_examples, args.max_seq_length,
         tokenizer, args.max_context_length,
-        args.context_standalone, args)
+        args.context_standalone, get_context_id_map(args.task_name),
+        label_map=label_map, num_workers=args.num_workers)
 
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_examples))
     logger.info("  Batch size = %d", args.train_batch_size)
     logger.info("  Num steps = %d", num_train_steps)
 
-    all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-    all_seq_len = torch.tensor([[f.seq_len] for f in train_features], dtype=torch.long)
-    all_context_ids = torch.tensor([f.context_ids for f in train_features], dtype=torch.long)
+    all_input_ids, all_input_mask, all_segment_ids, all_label_ids, \
+        all_seq_len, all_context_ids = [torch.from_numpy(a) for a in train_features]
 
-    train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                               all_label_ids, all_seq_len, all_context_ids)
+    train_data = FeatureBatchDataset(all_input_ids, all_input_mask, all_segment_ids,
+                                     all_label_ids, all_seq_len, all_context_ids)
+    # the samplers run in the prefetch thread, while the training draws
+    # dropout masks from the global generator
+    sampler_generator = torch.Generator()
+    sampler_generator.manual_seed(args.seed)
     if args.local_rank == -1:
         if sampler == "random":
-            train_sampler = RandomSampler(train_data)
+            train_sampler = RandomSampler(train_data, generator=sampler_generator)
         else:
             # consider switching to a weighted sampler
-            if args.task_name == "semeval_NLI_M":
-                sampler_weights = make_weights_for_balanced_classes(all_label_ids, 5)
-            else:
-                sampler_weights = make_weights_for_balanced_classes(all_label_ids, 2)
-            train_sampler = WeightedRandomSampler(sampler_weights, len(train_data), replacement=True)
+            sampler_weights = make_weights_for_balanced_classes(all_label_ids, len(label_list))
+            train_sampler = WeightedRandomSampler(sampler_weights, len(train_data), replacement=True,
+                                                  generator=sampler_generator)
+    else:
+        train_sampler = DistributedSampler(train_data, seed=args.seed)
+    if args.bucket_size > 0:
+        train_batch_sampler = BucketBatchSampler(train_sampler, all_seq_len,
+                                                 args.train_batch_size,
+                                                 bucket_size=args.bucket_size,
+                                                 generator=sampler_generator)
     else:
-        train_sampler = DistributedSampler(train_data)
-    train_dataloader = DataLoader(train_data, sampler=train_sampler,
-                                  batch_size=args.train_batch_size)
+        train_batch_sampler = BatchSampler(train_sampler, args.train_batch_size,
+                                           drop_last=False)
+    # every item of the batch sampler is gathered as a whole batch
+    train_dataloader = DataLoader(train_data, sampler=train_batch_sampler,
+                                  batch_size=None)
 
     # test set
     test_examples = processor.get_test_examples(args.data_dir)
-    test_features = convert_examples_to_features(
-        test_examples, label_list, args.max_seq_length,
+    test_features = cached_convert_examples_to_features(
+        args.feature_cache_dir, os.path.join(os.path.abspath(args.data_dir), "test"),
+        args.vocab_file, args.task_name,
+        test_examples, args.max_seq_length,
         tokenizer, args.max_context_length,
-        args.context_standalone, args)
+        args.context_standalone, get_context_id_map(args.task_name),
+        label_map=label_map, num_workers=args.num_workers)
 
-    all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_id for f in test_features], dtype=torch.long)
-    all_seq_len = torch.tensor([[f.seq_len] for f in test_features], dtype=torch.long)
-    all_context_ids = torch.tensor([f.context_ids for f in test_features], dtype=torch.long)
+    all_input_ids, all_input_mask, all_segment_ids, all_label_ids, \
+        all_seq_len, all_context_ids = [torch.from_numpy(a) for a in test_features]
 
-    test_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                all_label_ids, all_seq_len, all_context_ids)
-    test_dataloader = DataLoader(test_data, batch_size=args.eval_batch_size, shuffle=False)
+    test_data = FeatureBatchDataset(all_input_ids, all_input_mask, all_segment_ids,
+                                    all_label_ids, all_seq_len, all_context_ids)
+    test_batch_sampler = BatchSampler(SequentialSampler(test_data), args.eval_batch_size,
+                                      drop_last=False)
+    test_dataloader = DataLoader(test_data, sampler=test_batch_sampler, batch_size=None)
 
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
@@ -515,27 +406,17 @@ def evaluate_fast(test_dataloader, model, device, n_gpu, args):
     model.eval()
     test_loss, test_accuracy = 0, 0
     nb_test_steps, nb_test_examples = 0, 0
-    pbar = tqdm(test_dataloader, desc="Iteration")
+    batches = Prefetcher(test_dataloader, device, depth=args.prefetch_depth)
+    pbar = tqdm(batches, desc="Iteration")
     y_true, y_pred, score = [], [], []
     # we don't need gradient in this case.
-    with torch.no_grad():
+    with torch.no_grad(), autocast(device, args.precision):
         for _, batch in enumerate(pbar):
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
-            # truncate to save space and computing resource
+            # batches are already padded to their longest sequence and on device
             input_ids, input_mask, segment_ids, label_ids, seq_lens, \
                 context_ids = batch
-            max_seq_lens = max(seq_lens)[0]
-            input_ids = input_ids[:,:max_seq_lens]
-            input_mask = input_mask[:,:max_seq_lens]
-            segment_ids = segment_ids[:,:max_seq_lens]
-
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-            segment_ids = segment_ids.to(device)
-            label_ids = label_ids.to(device)
-            seq_lens = seq_lens.to(device)
-            context_ids = context_ids.to(device)
 
             # intentially with gradient
             tmp_test_loss, logits, _, _, _, _ = \
@@ -602,32 +483,23 @@ def evaluate_fast(test_dataloader, model, device, n_gpu, args):
 
 
 def evaluate(test_dataloader, model, device, n_gpu, nb_tr_steps, tr_loss, epoch,
-             global_step, output_log_file, global_best_acc, args):
+             global_step, output_log_file, global_best_acc, args,
+             checkpoint_writer=None):
 
     model.eval()
     test_loss, test_accuracy = 0, 0
     nb_test_steps, nb_test_examples = 0, 0
-    pbar = tqdm(test_dataloader, desc="Iteration")
+    batches = Prefetcher(test_dataloader, device, depth=args.prefetch_depth)
+    pbar = tqdm(batches, desc="Iteration")
     y_true, y_pred, score = [], [], []
     # we don't need gradient in this case.
-    with torch.no_grad():
+    with torch.no_grad(), autocast(device, args.precision):
         for _, batch in enumerate(pbar):
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
-            # truncate to save space and computing resource
+            # batches are already padded to their longest sequence and on device
             input_ids, input_mask, segment_ids, label_ids, seq_lens, \
                 context_ids = batch
-            max_seq_lens = max(seq_lens)[0]
-            input_ids = input_ids[:,:max_seq_lens]
-            input_mask = input_mask[:,:max_seq_lens]
-            segment_ids = segment_ids[:,:max_seq_lens]
-
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-            segment_ids = segment_ids.to(device)
-            label_ids = label_ids.to(device)
-            seq_lens = seq_lens.to(device)
-            context_ids = context_ids.to(device)
 
             # intentially with gradient
             tmp_test_loss, logits, _, _, _, _ = \
@@ -717,53 +589,43 @@ def evaluate(test_dataloader, model, device, n_gpu, nb_tr_steps, tr_loss, epoch,
         writer.write("\n")
 
     # save for each time point
-    if args.output_dir:
-        torch.save(model.state_dict(), args.output_dir + "checkpoint_" + str(global_step) + ".bin")
-        if args.task_name == "sentihood_NLI_M":
-            if aspect_strict_Acc > global_best_acc:
-                torch.save(model.state_dict(), args.output_dir + "best_checkpoint.bin")
-                global_best_acc = aspect_strict_Acc
-        elif args.task_name in ["fiqa_headline", "fiqa_post", "fiqa_acd"]:
-            if f > global_best_acc:
-                torch.save(model.state_dict(), args.output_dir + "best_checkpoint.bin")
-                global_best_acc = f
-        else:
-            if aspect_F > global_best_acc:
-                torch.save(model.state_dict(), args.output_dir + "best_checkpoint.bin")
-                global_best_acc = aspect_F
+    if args.task_name == "sentihood_NLI_M":
+        metric = aspect_strict_Acc
+    elif args.task_name in ["fiqa_headline", "fiqa_post", "fiqa_acd"]:
+        metric = f
+    else:
+        metric = aspect_F
+    if checkpoint_writer is not None:
+        checkpoint_writer.save(model, global_step, metric)
+    global_best_acc = max(global_best_acc, metric)
 
     return global_best_acc
 
 def step_train(train_dataloader, test_dataloader, model, optimizer, 
                device, n_gpu, evaluate_interval, global_step, 
-               output_log_file, epoch, global_best_acc, args):
+               output_log_file, epoch, global_best_acc, args,
+               checkpoint_writer=None):
     tr_loss = 0
     nb_tr_examples, nb_tr_steps = 0, 0
-    pbar = tqdm(train_dataloader, desc="Iteration")
+    padding_stats = PaddingStats()
+    start_time = time.time()
+    batches = Prefetcher(train_dataloader, device, depth=args.prefetch_depth)
+    pbar = tqdm(batches, desc="Iteration")
     for step, batch in enumerate(pbar):
         model.train()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
-        # truncate to save space and computing resource
+        # batches are already padded to their longest sequence and on device
         input_ids, input_mask, segment_ids, label_ids, seq_lens, \
             context_ids = batch
-        max_seq_lens = max(seq_lens)[0]
-        input_ids = input_ids[:,:max_seq_lens]
-        input_mask = input_mask[:,:max_seq_lens]
-        segment_ids = segment_ids[:,:max_seq_lens]
-
-        input_ids = input_ids.to(device)
-        input_mask = input_mask.to(device)
-        segment_ids = segment_ids.to(device)
-        label_ids = label_ids.to(device)
-        seq_lens = seq_lens.to(device)
-        context_ids = context_ids.to(device)
-
-        loss, _, _, _, _, _ = \
-            model(input_ids, segment_ids, input_mask, seq_lens,
-                            device=device, labels=label_ids,
-                            context_ids=context_ids)
+        padding_stats.update(input_ids, seq_lens)
+
+        with autocast(device, args.precision):
+            loss, _, _, _, _, _ = \
+                model(input_ids, segment_ids, input_mask, seq_lens,
+                                device=device, labels=label_ids,
+                                context_ids=context_ids)
         if n_gpu > 1:
             loss = loss.mean() # mean() to average on multi-gpu.
         if args.gradient_accumulation_steps > 1:
@@ -780,7 +642,15 @@ def step_train(train_dataloader, test_dataloader, model, optimizer,
 
         if global_step % evaluate_interval == 0:
             logger.info("***** Evaluation Interval Hit *****")
-            global_best_acc = evaluate(test_dataloader, model, device, n_gpu, nb_tr_steps, tr_loss, epoch, 
-                                       global_step, output_log_file, global_best_acc, args)
-
+            with batches.pause():
+                global_best_acc = evaluate(test_dataloader, model, device, n_gpu, nb_tr_steps, tr_loss, epoch, 
+                                           global_step, output_log_file, global_best_acc, args,
+                                           checkpoint_writer)
+
+    logger.info("padding ratio = %.3f, %.0f training tokens/s",
+                padding_stats.padding_ratio,
+                padding_stats.tokens / (time.time() - start_time - batches.paused_time))
+    logger.info("data wait = %.1fs, compute = %.1fs (%.1f%% waiting)",
+                batches.wait_time, batches.compute_time,
+                100 * batches.wait_fraction)
     return global_step, global_best_acc
\ No newline at end of file